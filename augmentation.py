@@ -0,0 +1,184 @@
+'''On-the-fly augmentation of the stored training split.
+
+AugmentedSequence applies a random scale, crop, horizontal flip and colour
+jitter to every sample as its batch is built. Image and label map go
+through the same sampling grid: bilinear for the image, nearest neighbour
+for the labels, so no new label values appear. Areas outside the scaled
+image are filled with the mean pixel and the ignore label. Batches are
+built on the fit_generator worker processes
+(use_multiprocessing=True) and queued ahead of the trainer.
+
+Augmentation throughput on its own, without a model:
+
+    python augmentation.py --X X_train.npy --y y_train.npy --workers 1 2 4 --output augment.json
+'''
+import argparse
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from benchmarking import write_report
+from data_generator import SegmentationSequence
+from data_utils import IGNORE_INDEX, VGG_MEAN_BGR
+
+MEAN_BGR = np.array(VGG_MEAN_BGR, dtype=np.float32)
+MEAN_RGB = MEAN_BGR[::-1]
+GRAY_WEIGHTS = np.array((0.299, 0.587, 0.114), dtype=np.float32)
+
+
+def to_rgb(X):
+    '''A stored image (preprocessed float BGR, or raw uint8 RGB) as float RGB 0-255.'''
+    if X.dtype == np.uint8:
+        return X.astype(np.float32)
+    return (X + MEAN_BGR)[..., ::-1]
+
+
+def from_rgb(rgb, dtype):
+    '''Back to the storage format of the image.'''
+    if dtype == np.uint8:
+        return np.clip(np.round(rgb), 0, 255).astype(np.uint8)
+    return rgb[..., ::-1] - MEAN_BGR
+
+
+def color_jitter(rgb, rng, brightness=32.0, contrast=0.25, saturation=0.25):
+    '''Random brightness offset, contrast and saturation factors.'''
+    gray = rgb.dot(GRAY_WEIGHTS)[..., np.newaxis]
+    rgb = gray + (rgb - gray) * rng.uniform(1 - saturation, 1 + saturation)
+    mean = rgb.mean()
+    rgb = mean + (rgb - mean) * rng.uniform(1 - contrast, 1 + contrast)
+    rgb = rgb + rng.uniform(-brightness, brightness)
+    return np.clip(rgb, 0, 255)
+
+
+def sample_coords(length, out_length, scale, offset):
+    '''Source coordinates of the out_length output pixels along one axis for
+    the image scaled by scale and cropped at offset, and which of them fall
+    inside the image.
+    '''
+    coords = (np.arange(out_length) + offset + 0.5) / scale - 0.5
+    valid = (coords >= -0.5) & (coords <= length - 0.5)
+    return np.clip(coords, 0, length - 1), valid
+
+
+def bilinear_sample(img, ys, xs, valid_y, valid_x, fill):
+    y0 = np.floor(ys).astype(np.int64)
+    x0 = np.floor(xs).astype(np.int64)
+    y1 = np.minimum(y0 + 1, img.shape[0] - 1)
+    x1 = np.minimum(x0 + 1, img.shape[1] - 1)
+    wy = (ys - y0)[:, np.newaxis, np.newaxis]
+    wx = (xs - x0)[np.newaxis, :, np.newaxis]
+    rows = img[y0] * (1 - wy) + img[y1] * wy
+    out = rows[:, x0] * (1 - wx) + rows[:, x1] * wx
+    out[~valid_y] = fill
+    out[:, ~valid_x] = fill
+    return out
+
+
+def nearest_sample(labels, ys, xs, valid_y, valid_x, fill):
+    out = labels[np.ix_(np.round(ys).astype(np.int64), np.round(xs).astype(np.int64))]
+    out[~valid_y] = fill
+    out[:, ~valid_x] = fill
+    return out
+
+
+def augment_pair(X, y, rng, out_size=None, scale_range=(0.75, 1.5), flip=True, jitter=True):
+    '''Randomly scales, crops to out_size (default: the input size), flips
+    and colour-jitters one image/label map pair.
+    '''
+    H, W = y.shape
+    out_h, out_w = out_size or (H, W)
+    scale = rng.uniform(*scale_range)
+    offsets = []
+    for length, out_length in ((H, out_h), (W, out_w)):
+        slack = length * scale - out_length
+        offsets.append(rng.uniform(min(slack, 0), max(slack, 0)))
+    ys, valid_y = sample_coords(H, out_h, scale, offsets[0])
+    xs, valid_x = sample_coords(W, out_w, scale, offsets[1])
+    if flip and rng.rand() < 0.5:
+        xs, valid_x = xs[::-1], valid_x[::-1]
+
+    rgb = to_rgb(X)
+    if jitter:
+        rgb = color_jitter(rgb, rng)
+    X_aug = from_rgb(bilinear_sample(rgb, ys, xs, valid_y, valid_x, MEAN_RGB), X.dtype)
+    y_aug = nearest_sample(y, ys, xs, valid_y, valid_x, IGNORE_INDEX)
+    return X_aug, y_aug
+
+
+class AugmentedSequence(SegmentationSequence):
+    '''SegmentationSequence with augment_pair applied to every sample. The
+    random draws depend only on (seed, epoch, batch index), so they do not
+    depend on which worker process builds a batch and are the same when a
+    run is resumed.
+    '''
+
+    def __init__(self, X_file, y_file, batch_size=1, shuffle=True, seed=None, sparse=True, n_classes=21,
+                 scale_range=(0.75, 1.5), flip=True, jitter=True, shard=None, sample_weights=None):
+        super(AugmentedSequence, self).__init__(X_file, y_file, batch_size, shuffle, seed, sparse, n_classes,
+                                                shard, sample_weights)
+        if len(self.X_files) != 1:
+            raise ValueError('AugmentedSequence needs an image store, not a list of feature stores')
+        self.scale_range = scale_range
+        self.flip = flip
+        self.jitter = jitter
+
+    def __getitem__(self, idx):
+        self._open()
+        batch_index = self._batch_rows(idx)
+        rng = np.random.RandomState([self.seed, self.epoch, idx + self.skip])
+        X = np.empty((len(batch_index),) + self._X[0].shape[1:], dtype=self._X[0].dtype)
+        y = np.empty((len(batch_index),) + self._y.shape[1:], dtype=np.uint8)
+        for i, row in enumerate(batch_index):
+            X[i], y[i] = augment_pair(self._X[0][row], self._y[row], rng, scale_range=self.scale_range,
+                                      flip=self.flip, jitter=self.jitter)
+        if X.dtype != np.uint8:
+            X = X.astype(np.float32)
+        return X, self._labels(y)
+
+
+_seq = None
+
+
+def _init_worker(seq):
+    global _seq
+    _seq = seq
+
+
+def _build_batch(idx):
+    X, _ = _seq[idx]
+    return len(X)
+
+
+def measure_throughput(seq, n_batches, workers):
+    '''Images/s of building n_batches batches of seq on a pool of workers.'''
+    n_batches = min(n_batches, len(seq))
+    pool = Pool(workers, initializer=_init_worker, initargs=(seq,))
+    try:
+        start = time.time()
+        n_images = sum(pool.imap(_build_batch, range(n_batches)))
+        seconds = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+    return {'workers': workers, 'batches': n_batches, 'images': n_images, 'seconds': seconds,
+            'images_per_s': n_images / seconds}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--X', default='X_train.npy')
+    parser.add_argument('--y', default='y_train.npy')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--batches', type=int, default=50)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = {}
+    for name, seq_class in (('stored', SegmentationSequence), ('augmented', AugmentedSequence)):
+        seq = seq_class(args.X, args.y, batch_size=args.batch_size, seed=0)
+        results[name] = [measure_throughput(seq, args.batches, workers) for workers in args.workers]
+        for result in results[name]:
+            print(name, result)
+    write_report(results, args.output)
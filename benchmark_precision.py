@@ -0,0 +1,97 @@
+'''Speed and mIoU of the FCN-8s model with the heads computed in reduced
+precision, against the float32 model.
+
+Each variant is built with models.build_fcn_models, filled from the same
+float32 checkpoint by layer name and run over the first --n-images of a
+stored split:
+
+  float32            the model as trained
+  float16            head_dtype='float16' (fc1 onwards in half precision)
+  bfloat16           head_dtype='bfloat16' (reported as an error where the
+                     Keras backend does not support it)
+  float32_raw_input  raw_input=True, fed uint8 images, VGG16 preprocessing
+                     in the graph
+
+    python benchmark_precision.py --model model_fcn_8s_tran_init.h5 --output precision.json
+'''
+import argparse
+import time
+
+import numpy as np
+
+import dataset_store
+from benchmarking import write_report
+from evaluation import evaluate_model
+from models import VGG_MEAN_BGR
+
+VARIANTS = ('float32', 'float16', 'bfloat16', 'float32_raw_input')
+
+
+def unpreprocess(X):
+    '''Inverse of the VGG16 preprocess_input: back to uint8 RGB.'''
+    return np.clip(np.round((X + np.array(VGG_MEAN_BGR, dtype=np.float32))[..., ::-1]), 0, 255).astype(np.uint8)
+
+
+def build_variant(variant, filepath):
+    import keras.backend as K
+    from models import build_fcn_models
+
+    K.clear_session()
+    if variant == 'float32_raw_input':
+        _, _, model_8 = build_fcn_models(raw_input=True)
+    else:
+        _, _, model_8 = build_fcn_models(head_dtype=None if variant == 'float32' else variant)
+    model_8.load_weights(filepath, by_name=True)
+    return model_8
+
+
+def run_variant(variant, filepath, X, y, batch_size):
+    model = build_variant(variant, filepath)
+    if variant == 'float32_raw_input':
+        X = unpreprocess(X)
+    model.predict(X[:batch_size], batch_size=batch_size)  # warm-up
+
+    start = time.time()
+    for i in range(0, len(X), batch_size):
+        model.predict(X[i:i + batch_size], batch_size=batch_size)
+    seconds = time.time() - start
+
+    cm = evaluate_model(model, X, y, batch_size=batch_size)
+    return {'images_per_s': len(X) / seconds,
+            'seconds': seconds,
+            'mean_IoU': cm.mean_IoU(),
+            'pixel_acc': cm.pixel_acc(),
+            'X_bytes_per_image': int(X[0].nbytes)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='model_fcn_8s_tran_init.h5', help='float32 checkpoint')
+    parser.add_argument('--X', default='X_fin_test.npy', help='preprocessed (float32) image store')
+    parser.add_argument('--y', default='y_fin_test.npy')
+    parser.add_argument('--n-images', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--variants', nargs='+', default=list(VARIANTS), choices=VARIANTS)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    X = np.asarray(dataset_store.open_array(args.X)[:args.n_images], dtype=np.float32)
+    y = np.asarray(dataset_store.open_array(args.y)[:args.n_images])
+
+    results = {}
+    for variant in args.variants:
+        try:
+            results[variant] = run_variant(variant, args.model, X, y, args.batch_size)
+        except Exception as e:
+            results[variant] = {'error': '%s: %s' % (type(e).__name__, e)}
+        print(variant, results[variant])
+
+    base = results.get('float32', {})
+    if 'mean_IoU' in base:
+        for variant, result in results.items():
+            if 'mean_IoU' in result:
+                result['speedup'] = result['images_per_s'] / base['images_per_s']
+                result['mean_IoU_delta'] = result['mean_IoU'] - base['mean_IoU']
+
+    summary = {'model': args.model, 'n_images': len(X), 'batch_size': args.batch_size, 'results': results}
+    write_report(summary, args.output)
@@ -0,0 +1,63 @@
+'''Cold-start benchmark for inference.py.
+
+Every measurement runs in a fresh interpreter so nothing is already
+imported or loaded:
+
+  import_s             import inference
+  model_load_s         get_model() (imports keras/tensorflow, loads the .h5)
+  first_prediction_s   the first predict() call on one 224x224 image
+  total_s              wall time of the whole child process, interpreter
+                       start-up included
+
+    python benchmark_startup.py --model model_fcn_8s_tran_init.h5 --repeat 3 --output startup.json
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarking import summarize, write_report
+
+CHILD = '''
+import json, sys, time
+t0 = time.time()
+import inference
+t1 = time.time()
+result = {"import_s": t1 - t0}
+if sys.argv[1]:
+    import numpy as np
+    model = inference.get_model(sys.argv[1])
+    t2 = time.time()
+    inference.predict(np.zeros((1, 224, 224, 3), dtype=np.uint8), sys.argv[1], batch_size=1)
+    t3 = time.time()
+    result.update(model_load_s=t2 - t1, first_prediction_s=t3 - t2)
+result["modules"] = sorted(m for m in ("keras", "tensorflow", "PIL", "sklearn", "matplotlib") if m in sys.modules)
+print(json.dumps(result))
+'''
+
+
+def run_once(model):
+    start = time.time()
+    out = subprocess.check_output([sys.executable, '-c', CHILD, model or ''],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+    result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    result['total_s'] = time.time() - start
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', help='model file; without it only the import is timed')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    runs = [run_once(args.model) for _ in range(args.repeat)]
+    summary = {'runs': runs}
+    for key in ('import_s', 'model_load_s', 'first_prediction_s', 'total_s'):
+        values = [r[key] for r in runs if key in r]
+        if values:
+            summary[key] = summarize(values)
+    write_report(summary, args.output)
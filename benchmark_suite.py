@@ -0,0 +1,186 @@
+'''Benchmarks of the data and model pipeline on synthetic VOC-shaped data.
+
+Random 500x375 JPEG images and colour label PNGs are generated from a fixed
+seed into a temporary directory, so no dataset (and no ImageNet weights)
+is needed and every run sees the same inputs. Stages:
+
+  label_decoding          convert_from_color_segmentation, one label image
+  jpeg_decode_preprocess  load_sample: JPEG/PNG decode, resize, preprocess
+  to_categorical_tensor   one-hot encoding of a batch of label maps
+  forward                 predict of model_32/16/8 for each --batch-sizes
+  metrics                 the Keras metrics on a batch, and the numpy
+                          ConfusionMatrix update
+
+Every timing is the median (with min/max) over --repeat runs. The JSON
+output also records the commit and library versions, so runs on two
+commits can be diffed directly.
+
+    python benchmark_suite.py --output bench.json [--stages forward metrics]
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from data_utils import palette, n_classes, convert_from_color_segmentation, labels_to_rgb, \
+    to_categorical_tensor, load_sample
+from benchmarking import timed, write_report
+from evaluation import ConfusionMatrix
+
+STAGES = ('label_decoding', 'jpeg_decode_preprocess', 'to_categorical_tensor', 'forward', 'metrics')
+VOC_SIZE = (375, 500)
+# colour of the object outlines in the VOC label images, decoded as ignore_index
+VOC_BORDER = (224, 224, 192)
+
+
+def synthetic_labels(rng, shape=VOC_SIZE, n_objects=4):
+    '''A label map with a few rectangular objects on background, outlined
+    with the ignore colour like the VOC annotations.
+    '''
+    labels = np.zeros(shape, dtype=np.uint8)
+    for _ in range(n_objects):
+        y0, x0 = rng.randint(0, shape[0] - 20), rng.randint(0, shape[1] - 20)
+        y1, x1 = rng.randint(y0 + 10, shape[0]), rng.randint(x0 + 10, shape[1])
+        labels[y0:y1, x0:x1] = 255
+        labels[y0 + 2:y1 - 2, x0 + 2:x1 - 2] = rng.randint(1, n_classes)
+    return labels
+
+
+def synthetic_image(rng, shape=VOC_SIZE):
+    '''Smooth random colours, so the JPEG decodes like a photo rather than noise.'''
+    small = rng.randint(0, 256, (shape[0] // 25 + 1, shape[1] // 25 + 1, 3)).astype(np.uint8)
+    return np.asarray(Image.fromarray(small).resize((shape[1], shape[0]), Image.BILINEAR))
+
+
+def write_dataset(root, n_images, seed=0):
+    '''Writes n_images JPEG/label PNG pairs VOC style, returns the base names.'''
+    rng = np.random.RandomState(seed)
+    X_path, y_path = os.path.join(root, 'JPEGImages'), os.path.join(root, 'SegmentationClass')
+    os.makedirs(X_path)
+    os.makedirs(y_path)
+    names = []
+    for i in range(n_images):
+        name = '2007_%06d' % i
+        Image.fromarray(synthetic_image(rng)).save(os.path.join(X_path, name + '.jpg'), quality=90)
+        labels = synthetic_labels(rng)
+        rgb = labels_to_rgb(labels, palette)
+        rgb[labels == 255] = VOC_BORDER
+        Image.fromarray(rgb).save(os.path.join(y_path, name + '.png'))
+        names.append(name)
+    return X_path, y_path, names
+
+
+def bench_label_decoding(ctx, repeat):
+    rgb = np.asarray(Image.open(os.path.join(ctx['y_path'], ctx['names'][0] + '.png')).convert('RGB'))
+    return {'voc_size': timed(lambda: convert_from_color_segmentation(rgb, palette), repeat)}
+
+
+def bench_jpeg_decode_preprocess(ctx, repeat):
+    names = ctx['names']
+
+    def load_all():
+        for name in names:
+            load_sample(name, ctx['X_path'], ctx['y_path'])
+    return {'load_sample': timed(load_all, repeat, len(names))}
+
+
+def bench_to_categorical_tensor(ctx, repeat):
+    results = {}
+    for batch_size in ctx['batch_sizes']:
+        y = ctx['y'][:batch_size]
+        results['batch_%d' % batch_size] = timed(lambda: to_categorical_tensor(y, n_classes), repeat, len(y))
+    return results
+
+
+def bench_forward(ctx, repeat):
+    from models import build_fcn_models
+
+    model_32, model_16, model_8 = build_fcn_models(weights=None)
+    results = {}
+    for name, model in (('model_32', model_32), ('model_16', model_16), ('model_8', model_8)):
+        for batch_size in ctx['batch_sizes']:
+            X = ctx['X'][:batch_size]
+            results['%s_batch_%d' % (name, batch_size)] = timed(
+                lambda: model.predict(X, batch_size=batch_size), repeat, len(X))
+    ctx['y_pred'] = model_8.predict(ctx['X'][:max(ctx['batch_sizes'])])
+    return results
+
+
+def bench_metrics(ctx, repeat):
+    import keras.backend as K
+    from metrics import sparse_mean_IoU, sparse_mean_acc, sparse_pixel_acc, segmentation_metrics
+
+    batch_size = max(ctx['batch_sizes'])
+    y = ctx['y'][:batch_size]
+    y_pred = ctx.get('y_pred')
+    if y_pred is None:
+        y_pred = np.random.RandomState(1).dirichlet(np.ones(n_classes), y.shape).astype(np.float32)
+
+    # fully shaped: the sparse_* metrics read n_classes off y_pred
+    y_true_t = K.placeholder(shape=(None,) + y.shape[1:] + (1,))
+    y_pred_t = K.placeholder(shape=(None,) + y_pred.shape[1:])
+    results = {}
+    for name, metric in (('mean_IoU', sparse_mean_IoU), ('mean_acc', sparse_mean_acc),
+                         ('pixel_acc', sparse_pixel_acc)):
+        fn = K.function([y_true_t, y_pred_t], [metric(y_true_t, y_pred_t)])
+        results[name] = timed(lambda: fn([y[..., np.newaxis].astype(np.float32), y_pred]), repeat, len(y))
+    # all three from one confusion matrix
+    fn = K.function([y_true_t, y_pred_t], [m(y_true_t, y_pred_t) for m in segmentation_metrics(n_classes)])
+    results['fused'] = timed(lambda: fn([y[..., np.newaxis].astype(np.float32), y_pred]), repeat, len(y))
+    results['confusion_matrix'] = timed(lambda: ConfusionMatrix(n_classes).update(y, y_pred), repeat, len(y))
+    return results
+
+
+def environment():
+    env = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+           'cpu_count': os.cpu_count()}
+    try:
+        env['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                                cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        env['commit'] = None
+    for module in ('keras', 'tensorflow'):
+        try:
+            env[module] = __import__(module).__version__
+        except ImportError:
+            env[module] = None
+    return env
+
+
+def run(stages=STAGES, n_images=16, batch_sizes=(1, 2, 4, 8), repeat=5, seed=0):
+    root = tempfile.mkdtemp(prefix='fcn_bench_')
+    try:
+        X_path, y_path, names = write_dataset(root, n_images, seed)
+        samples = [load_sample(name, X_path, y_path) for name in names]
+        ctx = {'X_path': X_path, 'y_path': y_path, 'names': names, 'batch_sizes': list(batch_sizes),
+               'X': np.stack([X for X, _ in samples]), 'y': np.stack([y for _, y in samples])}
+        results = {}
+        for stage in stages:
+            results[stage] = globals()['bench_' + stage](ctx, repeat)
+            print(stage, json.dumps(results[stage]))
+    finally:
+        shutil.rmtree(root)
+    return {'config': {'stages': list(stages), 'n_images': n_images, 'batch_sizes': list(batch_sizes),
+                       'repeat': repeat, 'seed': seed},
+            'environment': environment(),
+            'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--n-images', type=int, default=16)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    summary = run(args.stages, args.n_images, args.batch_sizes, args.repeat, args.seed)
+    write_report(summary, args.output)
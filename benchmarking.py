@@ -0,0 +1,42 @@
+'''Timing and reporting helpers shared by the benchmark scripts.'''
+import json
+import time
+from itertools import cycle
+
+import numpy as np
+
+
+def timed(fn, repeat, items=1):
+    '''Runs fn once to warm up, then repeat times. items is the number of
+    images one call processes, for the images/s figure.
+    '''
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    median = float(np.median(times))
+    return {'median_s': median, 'min_s': min(times), 'max_s': max(times),
+            'images_per_s': items / median if median > 0 else None}
+
+
+def predict_latency(model, X, batch_size=1, repeat=10):
+    '''Median seconds of one model.predict of batch_size images, after a
+    warm-up run. The runs cycle through the batches of X.
+    '''
+    batches = [X[i:i + batch_size] for i in range(0, max(len(X) - batch_size, 0) + 1, batch_size)]
+    batches = cycle(batches)
+    return timed(lambda: model.predict(next(batches), batch_size=batch_size), repeat, batch_size)['median_s']
+
+
+def summarize(values):
+    return {'median': float(np.median(values)), 'min': min(values), 'max': max(values)}
+
+
+def write_report(results, filepath=None):
+    '''Prints results as JSON and, if filepath is given, writes them there.'''
+    print(json.dumps(results, indent=2))
+    if filepath:
+        with open(filepath, 'w') as f:
+            json.dump(results, f, indent=2)
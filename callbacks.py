@@ -0,0 +1,114 @@
+import json
+import resource
+import sys
+import time
+
+import numpy as np
+from keras import backend as K
+from keras.callbacks import Callback
+
+
+def peak_rss_mb():
+    '''Peak resident set size of this process so far.'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+class TimingLogger(Callback):
+    '''Logs where the training time goes, as JSON lines in filepath.
+
+    fit_generator calls on_batch_begin once the batch has come out of the
+    generator queue, so the time between the end of one batch and the start
+    of the next is spent waiting for data and the time between begin and end
+    is the training step. Every log_every batches a 'batch' record is
+    written; each epoch ends with an 'epoch' record holding the totals,
+    images/s, the share of the time spent waiting for data (close to 1 means
+    the run is input bound) and the peak RSS.
+
+    metrics maps names to Keras metric functions (y_true, y_pred), which
+    may also return a list of tensors that are computed together. They are
+    timed on sample, an (X, y) batch, at the end of every epoch, outside the
+    batch timings.
+    '''
+
+    def __init__(self, filepath, metrics=None, sample=None, log_every=1):
+        super(TimingLogger, self).__init__()
+        self.filepath = filepath
+        self.metrics = metrics or {}
+        self.sample = sample
+        self.log_every = log_every
+        self._metric_fns = {}
+        self._file = None
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def on_train_begin(self, logs=None):
+        self._file = open(self.filepath, 'a')
+
+    def on_train_end(self, logs=None):
+        self._file.close()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_start = self.last_end = time.time()
+        self.wait = []
+        self.compute = []
+        self.images = 0
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batch_start = time.time()
+        self.wait.append(self.batch_start - self.last_end)
+
+    def on_batch_end(self, batch, logs=None):
+        self.last_end = time.time()
+        self.compute.append(self.last_end - self.batch_start)
+        size = int((logs or {}).get('size', 0))
+        self.images += size
+        if batch % self.log_every == 0:
+            self._write({'event': 'batch', 'epoch': self.epoch, 'batch': batch, 'size': size,
+                         'data_wait_s': self.wait[-1], 'compute_s': self.compute[-1]})
+
+    def time_metrics(self):
+        '''Seconds each metric takes on the sample batch (after a warm-up run).'''
+        if self.sample is None or not self.metrics:
+            return {}
+        X, y = self.sample
+        y_pred = self.model.predict(X)
+        y = np.asarray(y, dtype=np.float32)
+        times = {}
+        for name, metric in self.metrics.items():
+            fn = self._metric_fns.get(name)
+            if fn is None:
+                # fully shaped: the sparse_* metrics read n_classes off y_pred
+                y_true_t = K.placeholder(shape=(None,) + y.shape[1:])
+                y_pred_t = K.placeholder(shape=(None,) + y_pred.shape[1:])
+                outputs = metric(y_true_t, y_pred_t)
+                if not isinstance(outputs, list):
+                    outputs = [outputs]
+                fn = self._metric_fns[name] = K.function([y_true_t, y_pred_t], outputs)
+                fn([y, y_pred])
+            start = time.time()
+            fn([y, y_pred])
+            times[name] = time.time() - start
+        return times
+
+    def on_epoch_end(self, epoch, logs=None):
+        data_wait = float(np.sum(self.wait))
+        compute = float(np.sum(self.compute))
+        record = {'event': 'epoch', 'epoch': epoch,
+                  'epoch_s': time.time() - self.epoch_start,
+                  'batches': len(self.compute),
+                  'data_wait_s': data_wait,
+                  'compute_s': compute,
+                  'data_wait_fraction': data_wait / (data_wait + compute) if self.compute else None,
+                  'images_per_s': self.images / (data_wait + compute) if self.compute else None,
+                  'peak_rss_mb': peak_rss_mb(),
+                  'metric_eval_s': self.time_metrics(),
+                  'logs': dict((k, float(v)) for k, v in (logs or {}).items())}
+        self._write(record)
+        print('epoch %d: %.1f images/s, %.0f%% waiting for data, peak RSS %.0f MB'
+              % (epoch, record['images_per_s'] or 0, 100 * (record['data_wait_fraction'] or 0),
+                 record['peak_rss_mb']))
@@ -0,0 +1,163 @@
+'''Resumable training: periodic full-state checkpoints.
+
+A checkpoint holds the model weights, the optimizer state (iteration count
+and momentum slots), the epoch and number of batches done, the sequence
+seed, the Python/numpy RNG states and the best value seen by every
+ModelCheckpoint. fit_resumable continues an
+interrupted run from the last one, mid-epoch if that is where it stopped:
+the remaining batches of that epoch are exactly the ones the interrupted
+run had not trained on yet (SegmentationSequence orders every epoch by
+(seed, epoch)).
+
+The state is copied out of the session on the training thread at a batch
+boundary; pickling and writing it (the slow part for the ~500 MB FCN-8s)
+happens on a background thread.
+'''
+import os
+import pickle
+import random
+import threading
+from queue import Queue, Empty
+
+import numpy as np
+from keras.callbacks import Callback, History, ModelCheckpoint
+
+
+def save_state(state, filepath):
+    tmp = filepath + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, filepath)
+
+
+def load_state(filepath):
+    with open(filepath, 'rb') as f:
+        return pickle.load(f)
+
+
+def _writer(queue):
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        save_state(*item)
+
+
+class ResumableCheckpoint(Callback):
+    '''Saves the full training state to filepath every every_n_batches
+    batches and at the end of every epoch. Only one write is in flight; a
+    snapshot taken while the previous one is still being written replaces
+    any snapshot waiting behind it, so training never waits for the disk.
+
+    model_checkpoints are the ModelCheckpoint callbacks of the run; their
+    best values are saved too, so save_best_only keeps working after a
+    resume.
+    '''
+
+    def __init__(self, filepath, sequence, every_n_batches=500, model_checkpoints=()):
+        super(ResumableCheckpoint, self).__init__()
+        self.filepath = filepath
+        self.sequence = sequence
+        self.every_n_batches = every_n_batches
+        self.model_checkpoints = list(model_checkpoints)
+        # batch numbers restart at 0 when fit_resumable continues an epoch
+        self.batch_offset = 0
+        self._queue = None
+        self._thread = None
+
+    def snapshot(self, epoch, batches_done):
+        return {'epoch': epoch,
+                'batches_done': batches_done,
+                'batches_per_epoch': self.sequence.batches_per_epoch(),
+                'sequence_seed': self.sequence.seed,
+                'weights': self.model.get_weights(),
+                'optimizer_weights': self.model.optimizer.get_weights(),
+                'python_random_state': random.getstate(),
+                'numpy_random_state': np.random.get_state(),
+                'checkpoint_best': [cb.best for cb in self.model_checkpoints]}
+
+    def write(self, state):
+        if self._queue.full():
+            try:
+                self._queue.get_nowait()
+            except Empty:
+                pass
+        self._queue.put((state, self.filepath))
+
+    def on_train_begin(self, logs=None):
+        self._queue = Queue(maxsize=1)
+        self._thread = threading.Thread(target=_writer, args=(self._queue,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_batch_end(self, batch, logs=None):
+        batches_done = self.batch_offset + batch + 1
+        if batches_done % self.every_n_batches == 0:
+            self.write(self.snapshot(self.epoch, batches_done))
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.batch_offset = 0
+        self.write(self.snapshot(epoch, self.sequence.batches_per_epoch()))
+
+    def on_train_end(self, logs=None):
+        # the last snapshot has to be on disk before the process exits
+        self._queue.put(None)
+        self._thread.join()
+
+
+def restore(model, sequence, state, model_checkpoints=()):
+    '''Loads state into a compiled model and moves sequence to the first
+    batch that was not trained yet. Returns (epoch, skip).
+    '''
+    for cb, best in zip(model_checkpoints, state.get('checkpoint_best', [])):
+        cb.best = best
+    model.set_weights(state['weights'])
+    model._make_train_function()  # creates the optimizer slots
+    model.optimizer.set_weights(state['optimizer_weights'])
+    random.setstate(state['python_random_state'])
+    np.random.set_state(state['numpy_random_state'])
+
+    sequence.seed = state['sequence_seed']
+    epoch, skip = state['epoch'], state['batches_done']
+    if skip >= sequence.batches_per_epoch():
+        epoch, skip = epoch + 1, 0
+    sequence.set_position(epoch, skip)
+    return epoch, skip
+
+
+def fit_resumable(model, sequence, epochs, filepath, every_n_batches=500, callbacks=None, **kwargs):
+    '''model.fit_generator(sequence, epochs, ...) that checkpoints to
+    filepath and, if filepath exists, continues from it. The two
+    fit_generator calls a mid-epoch resume needs are merged into one
+    History.
+    '''
+    callbacks = list(callbacks or [])
+    # after them, so the epoch-end snapshot has their updated best values
+    model_checkpoints = [cb for cb in callbacks if isinstance(cb, ModelCheckpoint)]
+    checkpoint = ResumableCheckpoint(filepath, sequence, every_n_batches, model_checkpoints)
+    callbacks.append(checkpoint)
+    # batches must come in sequence order for the batch count to mean anything
+    kwargs['shuffle'] = False
+
+    epoch = 0
+    history = History()
+    history.history = {}
+    if os.path.exists(filepath):
+        epoch, skip = restore(model, sequence, load_state(filepath), model_checkpoints)
+        print('resuming at epoch %d, batch %d' % (epoch, skip))
+        if skip and epoch < epochs:
+            checkpoint.batch_offset = skip
+            partial = model.fit_generator(sequence, epochs=epoch + 1, initial_epoch=epoch, callbacks=callbacks,
+                                          **kwargs)
+            history.history.update(partial.history)
+            epoch += 1
+            sequence.set_position(epoch)
+
+    if epoch < epochs:
+        rest = model.fit_generator(sequence, epochs=epochs, initial_epoch=epoch, callbacks=callbacks, **kwargs)
+        for key, values in rest.history.items():
+            history.history.setdefault(key, []).extend(values)
+    return history
@@ -0,0 +1,97 @@
+'''Which VOC classes every stored image contains.
+
+dataset_store keeps a class index next to every label store (built when
+update_split ingests a split, or on first use): the pixel count of every
+class in every image and a packed presence bitmap. Picking the images that
+show a 'bottle', drawing a stratified subset or weighting images for
+class-balanced sampling then reads those small arrays instead of decoding
+the label maps.
+
+    python class_index.py --y y_fin_test.npy --classes bottle chair
+'''
+import argparse
+
+import numpy as np
+
+import dataset_store
+from data_utils import classes
+
+
+def class_ids(names):
+    '''Class indices of a list of class names and/or indices.'''
+    return [classes[c] if isinstance(c, str) else int(c) for c in names]
+
+
+class ClassIndex(object):
+    '''Class index of the label store y_file. counts is (N, n_classes)
+    pixels per image and class, present the same as booleans.
+    '''
+
+    def __init__(self, y_file, n_classes=21):
+        self.y_file = y_file
+        self.n_classes = n_classes
+        counts, bits = dataset_store.open_class_index(y_file, n_classes)
+        self.counts = np.asarray(counts)
+        self.present = np.unpackbits(bits, axis=1)[:, :n_classes].astype(bool)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def images_with(self, names, require_all=False, min_pixels=1):
+        '''Rows of the images that contain any (or all) of the classes in
+        names with at least min_pixels pixels each.
+        '''
+        ids = class_ids(names)
+        mask = self.present[:, ids] if min_pixels <= 1 else self.counts[:, ids] >= min_pixels
+        return np.flatnonzero(mask.all(axis=1) if require_all else mask.any(axis=1))
+
+    def images_per_class(self):
+        return self.present.sum(axis=0)
+
+    def stratified_sample(self, n_per_class, seed=0, names=None, background=0):
+        '''Sorted rows of up to n_per_class images for every class in names
+        (default: all but background). Rare classes are filled first, so an
+        image is not spent on a common class it also happens to contain.
+        '''
+        ids = [c for c in range(self.n_classes) if c != background] if names is None else class_ids(names)
+        rng = np.random.RandomState(seed)
+        n_images = self.images_per_class()
+        chosen = np.zeros(len(self), dtype=bool)
+        for c in sorted(ids, key=lambda c: n_images[c]):
+            have = np.count_nonzero(chosen & self.present[:, c])
+            candidates = np.flatnonzero(self.present[:, c] & ~chosen)
+            take = min(max(n_per_class - have, 0), len(candidates))
+            chosen[rng.choice(candidates, take, replace=False)] = True
+        return np.flatnonzero(chosen)
+
+    def balanced_weights(self, background=0):
+        '''Sampling probability of every image: the mean of 1 / (images that
+        contain c) over its foreground classes c, normalised to sum to 1.
+        Drawing by these weights shows every class about equally often.
+        Images with background only get the background class weight.
+        '''
+        present = self.present.astype(np.float64)
+        with np.errstate(divide='ignore'):
+            inv = np.where(self.images_per_class() > 0, 1.0 / self.images_per_class(), 0.0)
+        foreground = present.copy()
+        foreground[:, background] = 0
+        n_fg = foreground.sum(axis=1)
+        weights = np.where(n_fg > 0, foreground.dot(inv) / np.maximum(n_fg, 1), inv[background])
+        return weights / weights.sum()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--y', default='y_train.npy')
+    parser.add_argument('--classes', nargs='*', default=[], help='list the images containing these classes')
+    parser.add_argument('--all', action='store_true', help='images must contain every class given')
+    args = parser.parse_args()
+
+    index = ClassIndex(args.y)
+    names = sorted(classes, key=classes.get)
+    for name, n in zip(names, index.images_per_class()):
+        print('%-12s %6d images %12d pixels' % (name, n, index.counts[:, classes[name]].sum()))
+    if args.classes:
+        rows = index.images_with(args.classes, require_all=args.all)
+        print('%d images with %s: %s' % (len(rows), ' and '.join(args.classes) if args.all
+                                         else ' or '.join(args.classes), rows.tolist()))
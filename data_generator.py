@@ -0,0 +1,109 @@
+import numpy as np
+from keras.utils import Sequence
+
+import dataset_store
+from data_utils import to_categorical_tensor
+
+
+class SegmentationSequence(Sequence):
+    '''Streams (X, y) batches from a pair of dataset_store arrays. X_file may
+    also be a list of stores with the same number of rows (e.g. cached trunk
+    features), X is then a list of arrays.
+
+    Only the paths are pickled, each worker process opens its own memory map,
+    so fit_generator(workers=..., use_multiprocessing=True,
+    max_queue_size=...) prefetches batches without ever holding the whole
+    split in memory. Raw uint8 image stores are returned as uint8, the
+    others as float32. With sparse=True the labels are returned as
+    (batch, h, w, 1) uint8 maps for the sparse_* losses/metrics, otherwise
+    they are one-hot encoded per batch.
+
+    shard=(rank, n_shards) keeps every n_shards-th sample starting at rank,
+    for data-parallel training (distributed_train.py).
+
+    sample_weights (one per row, e.g. class_index.ClassIndex.balanced_weights)
+    makes every epoch draw its n_samples samples with replacement by these
+    weights instead of visiting each sample once.
+
+    The sample order of an epoch only depends on (seed, epoch), so a run can
+    be continued at any batch with set_position (checkpointing.py).
+    '''
+
+    def __init__(self, X_file, y_file, batch_size=1, shuffle=True, seed=None, sparse=True, n_classes=21,
+                 shard=None, sample_weights=None):
+        self.X_file = X_file
+        self.X_files = list(X_file) if isinstance(X_file, (list, tuple)) else [X_file]
+        self.y_file = y_file
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sparse = sparse
+        self.n_classes = n_classes
+        self.n_samples = dataset_store.read_meta(self.X_files[0])['shape'][0]
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.samples = np.arange(self.n_samples)
+        if shard is not None:
+            self.samples = self.samples[shard[0]::shard[1]]
+            self.n_samples = len(self.samples)
+        self.sample_p = None
+        if sample_weights is not None:
+            self.sample_p = np.asarray(sample_weights, dtype=np.float64)[self.samples]
+            self.sample_p /= self.sample_p.sum()
+        self._X = None
+        self._y = None
+        self.set_position(0)
+
+    def epoch_index(self, epoch):
+        '''The sample order of epoch.'''
+        if self.sample_p is not None:
+            return np.random.RandomState([self.seed, epoch]).choice(self.samples, self.n_samples, p=self.sample_p)
+        if not self.shuffle:
+            return self.samples
+        return np.random.RandomState([self.seed, epoch]).permutation(self.samples)
+
+    def set_position(self, epoch, skip=0):
+        '''Moves to epoch, leaving out its first skip batches (until the
+        epoch ends).
+        '''
+        self.epoch = epoch
+        self.skip = skip
+        self.index = self.epoch_index(epoch)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_X'] = None
+        state['_y'] = None
+        return state
+
+    def _open(self):
+        if self._X is None:
+            self._X = [dataset_store.open_array(f) for f in self.X_files]
+            self._y = dataset_store.open_array(self.y_file)
+
+    def batches_per_epoch(self):
+        return int(np.ceil(self.n_samples / float(self.batch_size)))
+
+    def __len__(self):
+        return self.batches_per_epoch() - self.skip
+
+    def _batch_rows(self, idx):
+        idx += self.skip
+        # sorted so the memory map is read front to back within a batch
+        return np.sort(self.index[idx * self.batch_size:(idx + 1) * self.batch_size])
+
+    def __getitem__(self, idx):
+        self._open()
+        batch_index = self._batch_rows(idx)
+        # raw uint8 images stay uint8, the model's vgg_preprocess casts them
+        X = [np.asarray(arr[batch_index], dtype=arr.dtype if arr.dtype == np.uint8 else np.float32)
+             for arr in self._X]
+        if len(X) == 1:
+            X = X[0]
+        return X, self._labels(self._y[batch_index])
+
+    def _labels(self, y):
+        if self.sparse:
+            return y[..., np.newaxis]
+        return to_categorical_tensor(y, self.n_classes)
+
+    def on_epoch_end(self):
+        self.set_position(self.epoch + 1)
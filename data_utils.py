@@ -0,0 +1,189 @@
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+classes = {'background': 0, 'aeroplane': 1, 'bicycle': 2, 'bird': 3, 'boat': 4,
+           'bottle': 5, 'bus': 6, 'car': 7, 'cat': 8,
+           'chair': 9, 'cow': 10, 'diningtable': 11, 'dog': 12,
+           'horse': 13, 'motorbike': 14, 'person': 15, 'potted-plant': 16,
+           'sheep': 17, 'sofa': 18, 'train': 19, 'tv/monitor': 20}
+
+palette = {
+           (0, 0, 0): 0,
+           (128, 0, 0): 1,
+           (0, 128, 0): 2,
+           (128, 128, 0): 3,
+           (0, 0, 128): 4,
+           (128, 0, 128): 5,
+           (0, 128, 128): 6,
+           (128, 128, 128): 7,
+           (64, 0, 0): 8,
+           (192, 0, 0): 9,
+           (64, 128, 0): 10,
+           (192, 128, 0): 11,
+           (64, 0, 128): 12,
+           (192, 0, 128): 13,
+           (64, 128, 128): 14,
+           (192, 128, 128): 15,
+           (0, 64, 0): 16,
+           (128, 64, 0): 17,
+           (0, 192, 0): 18,
+           (128, 192, 0): 19,
+           (0, 64, 128): 20}
+
+n_classes = len(classes)
+
+# label value for colours that are not in the palette, e.g. the VOC
+# (224, 224, 192) object boundary
+IGNORE_INDEX = 255
+
+# ImageNet channel means of the VGG16 weights, BGR order (vgg16.preprocess_input)
+VGG_MEAN_BGR = (103.939, 116.779, 123.68)
+
+_label_luts = {}
+_color_luts = {}
+
+
+def pack_rgb(arr_3d):
+    '''Packs an (..., 3) RGB array into one integer per pixel.'''
+    arr = np.asarray(arr_3d).astype(np.uint32)
+    return (arr[..., 0] << 16) | (arr[..., 1] << 8) | arr[..., 2]
+
+
+def build_label_lut(palette, ignore_index=IGNORE_INDEX):
+    '''Returns a 2**24 entry table mapping a packed RGB value to its class.'''
+    key = (tuple(sorted(palette.items())), ignore_index)
+    lut = _label_luts.get(key)
+    if lut is None:
+        lut = np.full(1 << 24, ignore_index, dtype=np.uint8)
+        colors = np.array(list(palette.keys()), dtype=np.uint32)
+        lut[pack_rgb(colors)] = np.array(list(palette.values()), dtype=np.uint8)
+        _label_luts[key] = lut
+    return lut
+
+
+def convert_from_color_segmentation(arr_3d, palette, ignore_index=IGNORE_INDEX):
+    '''Decodes an RGB label image (or a batch of them) to class indices with
+    a single table lookup. Colours missing from the palette get ignore_index.
+    '''
+    lut = build_label_lut(palette, ignore_index)
+    return lut[pack_rgb(arr_3d)]
+
+
+def build_color_lut(palette):
+    '''Returns a (256, 3) uint8 table mapping a class index to its colour.
+    Indices that are not in the palette render black.
+    '''
+    key = tuple(sorted(palette.items()))
+    lut = _color_luts.get(key)
+    if lut is None:
+        lut = np.zeros((256, 3), dtype=np.uint8)
+        for c, i in palette.items():
+            lut[i] = c
+        _color_luts[key] = lut
+    return lut
+
+
+def labels_to_rgb(labels, palette):
+    '''Renders a label map or a batch of them (N x H x W) to RGB in a single
+    gather.
+    '''
+    return build_color_lut(palette)[np.asarray(labels, dtype=np.uint8)]
+
+
+def labels_to_images(labels, palette, palettized=True):
+    '''Returns one PIL image per label map in the N x H x W batch. With
+    palettized=True the images are mode 'P' and share the palette, so no
+    RGB array is built at all.
+    '''
+    labels = np.asarray(labels, dtype=np.uint8)
+    if not palettized:
+        return [Image.fromarray(rgb, 'RGB') for rgb in labels_to_rgb(labels, palette)]
+
+    flat_palette = build_color_lut(palette).ravel().tolist()
+    images = []
+    for arr_2d in labels:
+        img = Image.fromarray(arr_2d, 'P')
+        img.putpalette(flat_palette)
+        images.append(img)
+    return images
+
+
+def convert_to_color_segmentation(arr_2d, palette):
+    return Image.fromarray(labels_to_rgb(arr_2d, palette), 'RGB')
+
+
+def to_categorical_tensor(x3d, n_cls):
+    '''One-hot encodes a batch of label maps. Pixels >= n_cls (ignore_index)
+    get an all-zero vector so they contribute nothing to the loss.
+    '''
+    eye = np.zeros((256, n_cls), dtype=np.float32)
+    eye[np.arange(n_cls), np.arange(n_cls)] = 1
+    return eye[np.asarray(x3d, dtype=np.uint8)]
+
+
+def read_file_list(txt_file):
+    with open(txt_file, 'rb') as f:
+        return [name.strip().decode("utf-8") for name in f if name.strip()]
+
+
+def load_sample(img_base_name, X_path, y_path, target_size=(224, 224), X_ext='.jpg', y_ext='.png', raw=False):
+    '''Loads one JPEG/label PNG pair. Returns (X_img, y_img) with X_img
+    passed through the VGG16 preprocess_input (or as raw uint8 RGB with
+    raw=True, for models that preprocess in the graph) and y_img as a uint8
+    class map, or None when the label image is not a colour image.
+    '''
+    from keras.preprocessing import image
+    from keras.applications.vgg16 import preprocess_input
+
+    y_img_name = os.path.join(y_path, str(img_base_name)) + y_ext
+    y_img = image.img_to_array(image.load_img(y_img_name, target_size=target_size))
+    if len(y_img.shape) <= 2:
+        return None
+
+    X_img_name = os.path.join(X_path, str(img_base_name)) + X_ext
+    X_img = image.img_to_array(image.load_img(X_img_name, target_size=target_size))
+    if raw:
+        X_img = X_img.astype(np.uint8)
+    else:
+        X_img = preprocess_input(X_img)
+
+    return X_img, convert_from_color_segmentation(y_img, palette)
+
+
+def load_split(img_names, X_path, y_path, target_size=(224, 224), X_ext='.jpg', y_ext='.png',
+               processes=None, chunksize=8, X_out=None, y_out=None, kept=None, raw=False):
+    '''Loads all the samples in img_names on a pool of worker processes.
+
+    Results come back in file order and are written straight into X_out and
+    y_out (preallocated here if not given, may also be memory-mapped
+    arrays). Samples rejected by load_sample are dropped, so the returned
+    arrays are views of the first n_loaded rows; pass a list as kept to get
+    the positions in img_names of the rows that were loaded.
+    '''
+    n = len(img_names)
+    if X_out is None:
+        X_out = np.empty((n,) + tuple(target_size) + (3,), dtype=np.uint8 if raw else np.float32)
+    if y_out is None:
+        y_out = np.empty((n,) + tuple(target_size), dtype=np.uint8)
+
+    worker = partial(load_sample, X_path=X_path, y_path=y_path, target_size=target_size,
+                     X_ext=X_ext, y_ext=y_ext, raw=raw)
+    count = 0
+    pool = Pool(processes)
+    try:
+        for i, sample in enumerate(pool.imap(worker, img_names, chunksize=chunksize)):
+            if sample is None:
+                continue
+            X_out[count], y_out[count] = sample
+            count += 1
+            if kept is not None:
+                kept.append(i)
+    finally:
+        pool.close()
+        pool.join()
+
+    return X_out[:count], y_out[:count]
@@ -0,0 +1,302 @@
+import hashlib
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+
+import data_utils
+
+# bump whenever load_sample / preprocess_input / the palette change in a way
+# that makes previously written arrays stale
+PREPROCESS_VERSION = 2
+
+
+def meta_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def write_meta(path, shape, dtype, n_classes, **extra):
+    meta = {'shape': list(shape),
+            'dtype': np.dtype(dtype).str,
+            'n_classes': n_classes,
+            'preprocess_version': PREPROCESS_VERSION}
+    meta.update(extra)
+    with open(meta_path(path), 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+    return meta
+
+
+def read_meta(path):
+    with open(meta_path(path)) as f:
+        return json.load(f)
+
+
+def exists(path):
+    return os.path.isfile(path) and os.path.isfile(meta_path(path))
+
+
+def create_array(path, shape, dtype, n_classes, **extra):
+    '''Creates a writable memory-mapped .npy array plus its metadata header.'''
+    write_meta(path, shape, dtype, n_classes, **extra)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+
+def save_array(path, data, n_classes, **extra):
+    out = create_array(path, data.shape, data.dtype, n_classes, **extra)
+    out[...] = data
+    out.flush()
+    return out
+
+
+def open_array(path, mode='r'):
+    '''Opens a stored array without reading it; pages are faulted in as the
+    samples are touched.
+    '''
+    meta = read_meta(path)
+    if meta['preprocess_version'] != PREPROCESS_VERSION:
+        raise ValueError('%s was written with preprocessing version %s, expected %s'
+                         % (path, meta['preprocess_version'], PREPROCESS_VERSION))
+    arr = np.load(path, mmap_mode=mode)
+    if list(arr.shape) != meta['shape'] or arr.dtype.str != meta['dtype']:
+        raise ValueError('%s does not match its metadata header' % path)
+    return arr
+
+
+def one_hot_to_labels(y, ignore_index=data_utils.IGNORE_INDEX):
+    '''(..., n_classes) one-hot labels to uint8 class indices; all-zero rows
+    (pixels the old decoder matched to no class) become ignore_index.
+    '''
+    labels = np.asarray(y.argmax(axis=-1), dtype=np.uint8)
+    labels[~y.any(axis=-1)] = ignore_index
+    return labels
+
+
+def convert_pickle(pkl_path, npy_path, n_classes=21):
+    '''Converts one of the old X_*.pkl / y_*.pkl pickles to the array store.
+    The y pickles hold one-hot float tensors, they are stored as uint8 class
+    indices like every other y store.
+
+    The pickles do not record which images they were built from, so the
+    converted stores get no manifest: they are for reading with open_array
+    (test_model.py, evaluation.py), and update_split rebuilds the split from
+    the images instead of reusing them.
+    '''
+    with open(pkl_path, 'rb') as f:
+        data = np.asarray(pickle.load(f))
+    if data.ndim == 4 and data.shape[-1] == n_classes:
+        data = one_hot_to_labels(data)
+    return save_array(npy_path, data, n_classes)
+
+
+def manifest_path(X_file):
+    return os.path.splitext(X_file)[0] + '.manifest.json'
+
+
+def preprocess_params(target_size=(224, 224), X_ext='.jpg', y_ext='.png', raw=False):
+    '''Everything besides the input files that determines the cached arrays.'''
+    return {'preprocess_version': PREPROCESS_VERSION,
+            'preprocess_input': None if raw else 'keras.applications.vgg16.preprocess_input',
+            'target_size': list(target_size),
+            'X_ext': X_ext,
+            'y_ext': y_ext,
+            'palette': sorted([list(c), i] for c, i in data_utils.palette.items()),
+            'ignore_index': data_utils.IGNORE_INDEX}
+
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fingerprint(path, previous=None):
+    '''Returns size, mtime and sha1 of a file. The file is only hashed again
+    when its size or mtime differ from the previous fingerprint.
+    '''
+    st = os.stat(path)
+    fp = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    if previous is not None and previous['size'] == fp['size'] and previous['mtime'] == fp['mtime']:
+        fp['sha1'] = previous['sha1']
+    else:
+        fp['sha1'] = file_sha1(path)
+    return fp
+
+
+def manifest_key(params, img_names, files):
+    h = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8'))
+    for name in img_names:
+        h.update(('%s %s %s\n' % (name, files[name]['X']['sha1'], files[name]['y']['sha1'])).encode('utf-8'))
+    return h.hexdigest()
+
+
+def read_manifest(X_file):
+    path = manifest_path(X_file)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(X_file, manifest):
+    tmp_path = manifest_path(X_file) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(tmp_path, manifest_path(X_file))
+
+
+def _replace_array(tmp_path, path):
+    os.replace(tmp_path, path)
+    os.replace(meta_path(tmp_path), meta_path(path))
+
+
+def class_index_paths(y_file):
+    base = os.path.splitext(y_file)[0]
+    return base + '.class_counts.npy', base + '.class_bits.npy'
+
+
+def count_classes(y, n_classes=21):
+    '''Pixels of every class in every label map of y, as (N, n_classes)
+    uint32. Ignored pixels (>= n_classes) are not counted.
+    '''
+    y = np.asarray(y).reshape(len(y), -1)
+    flat = y.astype(np.int64) + (np.arange(len(y)) * 256)[:, np.newaxis]
+    counts = np.bincount(flat.ravel(), minlength=len(y) * 256).reshape(len(y), 256)
+    return counts[:, :n_classes].astype(np.uint32)
+
+
+def build_class_index(y_file, n_classes=21, chunk_size=256):
+    '''Writes the class index of the y_file store next to it: the pixel
+    count of every class in every image, and the same as a bitmap of the
+    classes present (np.packbits, 3 bytes per image for VOC).
+    '''
+    y = open_array(y_file)
+    counts_path, bits_path = class_index_paths(y_file)
+    source = {'source': y_file, 'source_mtime': os.path.getmtime(y_file)}
+    counts = create_array(counts_path, (len(y), n_classes), np.uint32, n_classes, **source)
+    for start in range(0, len(y), chunk_size):
+        counts[start:start + chunk_size] = count_classes(y[start:start + chunk_size], n_classes)
+    counts.flush()
+    save_array(bits_path, np.packbits(np.asarray(counts) > 0, axis=1), n_classes, **source)
+
+
+def class_index_current(y_file):
+    paths = class_index_paths(y_file)
+    if not all(exists(p) for p in paths):
+        return False
+    source_mtime = os.path.getmtime(y_file)
+    return all(read_meta(p).get('source_mtime') == source_mtime for p in paths)
+
+
+def open_class_index(y_file, n_classes=21):
+    '''(counts, bits) of y_file, built first if missing or stale.'''
+    if not class_index_current(y_file):
+        build_class_index(y_file, n_classes)
+    return tuple(open_array(p) for p in class_index_paths(y_file))
+
+
+def update_split(img_names, X_file, y_file, X_path, y_path, n_classes=21, target_size=(224, 224),
+                 X_ext='.jpg', y_ext='.png', raw=False, **kwargs):
+    '''Brings the X_file/y_file stores up to date with img_names.
+
+    A manifest next to X_file records the preprocessing parameters and the
+    size, mtime and sha1 of every input file. If the parameters changed the
+    split is rebuilt from scratch; otherwise only added or changed images are
+    decoded (on the load_split pool) and every other row is copied over from
+    the existing store. Returns (X, y, changed) with X and y opened
+    read-only. The class index of y_file (build_class_index) is kept up to
+    date as well.
+
+    With raw=True X holds the uint8 RGB pixels, a quarter of the float32
+    size, and the model has to do the VGG16 preprocessing itself (see
+    models.build_fcn_models(raw_input=True)).
+    '''
+    params = preprocess_params(target_size, X_ext, y_ext, raw)
+    X_dtype = np.uint8 if raw else np.float32
+    manifest = read_manifest(X_file)
+    if manifest is None or manifest['params'] != params or not (exists(X_file) and exists(y_file)):
+        manifest = {'params': params, 'key': None, 'files': {}}
+
+    files = {}
+    todo = []
+    for name in img_names:
+        previous = manifest['files'].get(name)
+        entry = {'X': fingerprint(os.path.join(X_path, name) + X_ext, previous and previous['X']),
+                 'y': fingerprint(os.path.join(y_path, name) + y_ext, previous and previous['y']),
+                 'row': None}
+        if previous is not None and previous['X']['sha1'] == entry['X']['sha1'] \
+                and previous['y']['sha1'] == entry['y']['sha1']:
+            entry['row'] = previous['row']
+        else:
+            todo.append(name)
+        files[name] = entry
+
+    key = manifest_key(params, img_names, files)
+    if key == manifest['key']:
+        if not class_index_current(y_file):
+            build_class_index(y_file, n_classes)
+        return open_array(X_file), open_array(y_file), False
+
+    X_tmp = os.path.splitext(X_file)[0] + '.tmp.npy'
+    y_tmp = os.path.splitext(y_file)[0] + '.tmp.npy'
+    X_shape = tuple(target_size) + (3,)
+    kept = []
+    if manifest['key'] is None or len(todo) == len(img_names):
+        # nothing to reuse, decode straight into the new store
+        X_out = create_array(X_tmp, (len(todo),) + X_shape, X_dtype, n_classes)
+        y_out = create_array(y_tmp, (len(todo),) + tuple(target_size), np.uint8, n_classes)
+        data_utils.load_split(todo, X_path, y_path, target_size=target_size, X_ext=X_ext, y_ext=y_ext,
+                              X_out=X_out, y_out=y_out, kept=kept, raw=raw, **kwargs)
+        if len(kept) < len(todo):
+            # some label images were rejected, shrink the store to the loaded rows
+            X_out = save_array(X_tmp, np.array(X_out[:len(kept)]), n_classes)
+            y_out = save_array(y_tmp, np.array(y_out[:len(kept)]), n_classes)
+        for row, i in enumerate(kept):
+            files[todo[i]]['row'] = row
+    else:
+        X_new, y_new = data_utils.load_split(todo, X_path, y_path, target_size=target_size, X_ext=X_ext,
+                                             y_ext=y_ext, kept=kept, raw=raw, **kwargs)
+        new_rows = dict((todo[i], j) for j, i in enumerate(kept))
+        todo_set = set(todo)
+
+        # rows follow img_names order, rejected label images get no row
+        order = [name for name in img_names
+                 if name in new_rows or (name not in todo_set and files[name]['row'] is not None)]
+        X_out = create_array(X_tmp, (len(order),) + X_shape, X_dtype, n_classes)
+        y_out = create_array(y_tmp, (len(order),) + tuple(target_size), np.uint8, n_classes)
+        X_old = open_array(X_file)
+        y_old = open_array(y_file)
+        for row, name in enumerate(order):
+            if name in new_rows:
+                X_out[row], y_out[row] = X_new[new_rows[name]], y_new[new_rows[name]]
+            else:
+                X_out[row], y_out[row] = X_old[files[name]['row']], y_old[files[name]['row']]
+            files[name]['row'] = row
+        del X_old, y_old
+    X_out.flush()
+    y_out.flush()
+    n = len(X_out)
+    del X_out, y_out
+
+    _replace_array(X_tmp, X_file)
+    _replace_array(y_tmp, y_file)
+    write_manifest(X_file, {'params': params, 'key': key, 'files': files})
+    build_class_index(y_file, n_classes)
+    print('%s: %d images reprocessed, %d reused' % (X_file, len(todo), n - len(kept)))
+    return open_array(X_file), open_array(y_file), True
+
+
+if __name__ == '__main__':
+    # python dataset_store.py [X_train.pkl y_train.pkl ...]
+    pkl_files = sys.argv[1:] or ['X_train.pkl', 'y_train.pkl', 'X_val.pkl', 'y_val.pkl',
+                                 'X_fin_test.pkl', 'y_fin_test.pkl']
+    for pkl_file in pkl_files:
+        if not os.path.isfile(pkl_file):
+            print('skipping %s (not found)' % pkl_file)
+            continue
+        npy_file = os.path.splitext(pkl_file)[0] + '.npy'
+        arr = convert_pickle(pkl_file, npy_file)
+        print('%s -> %s %s %s' % (pkl_file, npy_file, arr.shape, arr.dtype))
@@ -0,0 +1,114 @@
+'''FCN decoder variants: converting checkpoints and measuring the savings.
+
+The FCN heads upsample the 21-channel scores and only then apply a 1x1
+convolution, so FCN-8s runs its last conv on 224x224x21 (and FCN-32s after a
+32x upsample). build_fcn_models(decoder='coarse') applies every 1x1 conv
+before the upsampling in front of it, which gives the same scores since
+nearest and bilinear upsampling commute with 1x1 convolutions.
+
+    python decoders.py convert --model model_fcn_8s_tran_init.h5 --output model_fcn_8s_coarse.h5
+    python decoders.py benchmark --output decoders.json
+'''
+import argparse
+
+import numpy as np
+
+from benchmarking import predict_latency, write_report
+
+VARIANTS = (('full', 'nearest'), ('coarse', 'nearest'), ('full', 'bilinear'), ('coarse', 'bilinear'))
+
+
+def convert(filepath, output, decoder='coarse', upsampling='nearest'):
+    '''Loads an FCN-8s checkpoint into the given decoder variant by layer
+    name and saves it as a complete model.
+    '''
+    from models import build_fcn_models, load_weights
+
+    _, _, model_8 = build_fcn_models(weights=None, decoder=decoder, upsampling=upsampling)
+    load_weights(model_8, filepath)
+    model_8.save(output)
+    return model_8
+
+
+def head_layers(model):
+    return [layer for layer in model.layers if not layer.name.startswith(('input', 'block', 'vgg'))]
+
+
+def activation_bytes(model):
+    '''Bytes of float32 activations one image produces after the VGG16 trunk.'''
+    return int(sum(4 * np.prod(layer.output_shape[1:]) for layer in head_layers(model)))
+
+
+def decoder_macs(model):
+    '''Multiply-adds per image of the 21-channel scoring convolutions.'''
+    from keras.layers import Conv2D
+
+    macs = 0
+    for layer in head_layers(model):
+        if isinstance(layer, Conv2D) and layer.filters == 21:
+            kernel = layer.get_weights()[0]
+            macs += np.prod(layer.output_shape[1:3]) * kernel.size
+    return int(macs)
+
+
+def benchmark(batch_sizes=(1, 8), repeat=10, filepath=None, seed=0):
+    '''Times model_8 of every variant with identical weights (random, or
+    from filepath), and checks each against the full decoder with the same
+    upsampling.
+    '''
+    import keras.backend as K
+    from models import build_fcn_models
+
+    X = np.random.RandomState(seed).uniform(-120, 150, (max(batch_sizes), 224, 224, 3)).astype(np.float32)
+    weights = None
+    reference = {}
+    results = {}
+    for decoder, upsampling in VARIANTS:
+        K.clear_session()
+        _, _, model_8 = build_fcn_models(weights=None, decoder=decoder, upsampling=upsampling)
+        if weights is None:
+            if filepath is not None:
+                model_8.load_weights(filepath, by_name=True)
+            weights = dict((layer.name, layer.get_weights()) for layer in model_8.layers if layer.get_weights())
+        else:
+            for name, w in weights.items():
+                model_8.get_layer(name).set_weights(w)
+
+        y = model_8.predict(X[:1])
+        if decoder == 'full':
+            reference[upsampling] = y
+        result = {'activation_mb_per_image': activation_bytes(model_8) / 2.0 ** 20,
+                  'decoder_macs_per_image': decoder_macs(model_8),
+                  'max_abs_diff_vs_full': float(np.abs(y - reference[upsampling]).max())}
+        for batch_size in batch_sizes:
+            result['latency_batch_%d_s' % batch_size] = predict_latency(model_8, X, batch_size, repeat)
+        results['%s_%s' % (decoder, upsampling)] = result
+        print(decoder, upsampling, result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+
+    convert_parser = commands.add_parser('convert', help='convert an FCN-8s checkpoint to another decoder')
+    convert_parser.add_argument('--model', required=True)
+    convert_parser.add_argument('--output', required=True)
+    convert_parser.add_argument('--decoder', default='coarse', choices=('full', 'coarse'))
+    convert_parser.add_argument('--upsampling', default='nearest', choices=('nearest', 'bilinear'))
+
+    bench_parser = commands.add_parser('benchmark', help='memory and latency of the decoder variants')
+    bench_parser.add_argument('--model', help='checkpoint to load (default: random weights)')
+    bench_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8])
+    bench_parser.add_argument('--repeat', type=int, default=10)
+    bench_parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        convert(args.model, args.output, args.decoder, args.upsampling)
+        print('wrote %s' % args.output)
+    elif args.command == 'benchmark':
+        results = benchmark(args.batch_sizes, args.repeat, args.model)
+        write_report(results, args.output)
+    else:
+        parser.print_help()
@@ -0,0 +1,197 @@
+'''Data-parallel FCN-8s training on several local worker processes.
+
+Every worker holds a full model_8 replica and trains on its own shard of
+X_train (every n-th sample); after each batch the gradients are averaged
+over all workers with an allreduce (Horovod), so the replicas stay in sync
+and one step covers n_workers x batch_size images. Workers are placed by
+horovodrun, localhost:N stands in for a multi-host cluster:
+
+    horovodrun -np 4 -H localhost:4 python distributed_train.py train --epochs 10
+
+Scaling benchmark, images/s against the number of workers (each count is a
+separate horovodrun launch):
+
+    python distributed_train.py benchmark --workers 1 2 4 --steps 30 --output scaling.json
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarking import write_report
+
+
+def setup_worker():
+    '''Initialises Horovod and splits the CPU cores between the local workers.'''
+    import tensorflow as tf
+    import keras.backend as K
+    import horovod.keras as hvd
+
+    hvd.init()
+    threads = max(1, (os.cpu_count() or 1) // hvd.local_size())
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=2)
+    K.set_session(tf.Session(config=config))
+    return hvd
+
+
+def build_model(hvd, lr=1e-4, scale_lr=True):
+    '''model_8 as in train.py (only the last 11 layers trainable), compiled
+    with an optimizer that averages gradients over the workers.
+    '''
+    import horovod.tensorflow as hvd_tf
+    from keras import optimizers
+    from metrics import sparse_fcn_xent_nobg, segmentation_metrics
+    from models import build_fcn_models
+
+    _, _, model_8 = build_fcn_models()
+    for layer in model_8.layers[:-11]:
+        layer.trainable = False
+
+    # n workers take n times larger steps, scale the learning rate with them;
+    # everything else as in train.py
+    sgd = optimizers.SGD(lr=lr * hvd.size() if scale_lr else lr, decay=2e-5, momentum=0.9, nesterov=True)
+    # the scores come from the confusion matrices summed over all workers,
+    # i.e. over the whole split, not from an average of per-worker scores
+    model_8.compile(loss=sparse_fcn_xent_nobg, optimizer=hvd.DistributedOptimizer(sgd),
+                    metrics=segmentation_metrics(reduce=lambda m: hvd_tf.allreduce(m, average=False)))
+    return model_8
+
+
+def sharded_sequence(hvd, X_file, y_file, batch_size, shuffle, augment=False):
+    from augmentation import AugmentedSequence
+    from data_generator import SegmentationSequence
+
+    seq_class = AugmentedSequence if augment else SegmentationSequence
+    return seq_class(X_file, y_file, batch_size=batch_size, shuffle=shuffle, seed=hvd.rank(),
+                     shard=(hvd.rank(), hvd.size()))
+
+
+def steps_per_worker(hvd, X_file, batch_size):
+    '''Batches every worker runs per epoch. Allreduce needs the same number
+    on every worker, so it is based on the smallest shard.
+    '''
+    import dataset_store
+
+    n_samples = dataset_store.read_meta(X_file)['shape'][0]
+    return max(1, (n_samples // hvd.size()) // batch_size)
+
+
+def train(args):
+    from keras.callbacks import ModelCheckpoint
+    from callbacks import TimingLogger
+
+    hvd = setup_worker()
+    model_8 = build_model(hvd, args.lr)
+    train_seq = sharded_sequence(hvd, args.X_train, args.y_train, args.batch_size, True, args.augment)
+    val_seq = sharded_sequence(hvd, args.X_val, args.y_val, args.batch_size, False)
+
+    # MetricAverageCallback averages the loss; the scores are already the
+    # same on every worker
+    callbacks_list = [hvd.callbacks.BroadcastGlobalVariablesCallback(0),
+                      hvd.callbacks.MetricAverageCallback()]
+    if hvd.rank() == 0:
+        callbacks_list.append(ModelCheckpoint(args.checkpoint, monitor='val_mean_IoU', verbose=1,
+                                              save_best_only=True, mode='max'))
+        callbacks_list.append(TimingLogger('training_log_distributed.jsonl'))
+
+    t = time.time()
+    model_8.fit_generator(train_seq, steps_per_epoch=steps_per_worker(hvd, args.X_train, args.batch_size),
+                          epochs=args.epochs, verbose=1 if hvd.rank() == 0 else 0, validation_data=val_seq,
+                          validation_steps=steps_per_worker(hvd, args.X_val, args.batch_size),
+                          callbacks=callbacks_list, workers=args.loader_workers, use_multiprocessing=True)
+    if hvd.rank() == 0:
+        print('Training time: %s' % (time.time() - t))
+        model_8.save(args.output)
+
+
+def measure(args):
+    '''Runs args.steps synchronous steps after args.warmup steps and writes
+    the aggregate images/s (rank 0) to args.result.
+    '''
+    hvd = setup_worker()
+    model_8 = build_model(hvd)
+    seq = sharded_sequence(hvd, args.X_train, args.y_train, args.batch_size, True)
+    callbacks_list = [hvd.callbacks.BroadcastGlobalVariablesCallback(0)]
+
+    model_8.fit_generator(seq, steps_per_epoch=args.warmup, epochs=1, verbose=0, callbacks=callbacks_list,
+                          workers=args.loader_workers, use_multiprocessing=True)
+    start = time.time()
+    model_8.fit_generator(seq, steps_per_epoch=args.steps, epochs=1, verbose=0,
+                          workers=args.loader_workers, use_multiprocessing=True)
+    seconds = time.time() - start
+    if hvd.rank() == 0:
+        images = args.steps * args.batch_size * hvd.size()
+        with open(args.result, 'w') as f:
+            json.dump({'workers': hvd.size(), 'steps': args.steps, 'batch_size': args.batch_size,
+                       'images': images, 'seconds': seconds, 'images_per_s': images / seconds}, f)
+
+
+def benchmark(args):
+    '''Launches measure with horovodrun for every worker count.'''
+    results = []
+    for n in args.workers:
+        fd, result = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        cmd = ['horovodrun', '-np', str(n), '-H', 'localhost:%d' % n,
+               sys.executable, os.path.abspath(__file__), 'measure', '--result', result,
+               '--steps', str(args.steps), '--warmup', str(args.warmup), '--batch-size', str(args.batch_size),
+               '--X-train', args.X_train, '--y-train', args.y_train,
+               '--loader-workers', str(args.loader_workers)]
+        subprocess.check_call(cmd)
+        with open(result) as f:
+            results.append(json.load(f))
+        os.remove(result)
+        print(results[-1])
+
+    base = results[0]['images_per_s'] / results[0]['workers']
+    for r in results:
+        r['speedup'] = r['images_per_s'] / results[0]['images_per_s']
+        r['efficiency'] = r['images_per_s'] / (base * r['workers'])
+    summary = {'cpu_count': os.cpu_count(), 'results': results}
+    write_report(summary, args.output)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--X-train', default='X_train.npy')
+    common.add_argument('--y-train', default='y_train.npy')
+    common.add_argument('--batch-size', type=int, default=1, help='per worker')
+    common.add_argument('--loader-workers', type=int, default=2, help='batch loading processes per worker')
+
+    train_parser = commands.add_parser('train', parents=[common], help='train (run under horovodrun)')
+    train_parser.add_argument('--X-val', default='X_val.npy')
+    train_parser.add_argument('--y-val', default='y_val.npy')
+    train_parser.add_argument('--epochs', type=int, default=10)
+    train_parser.add_argument('--lr', type=float, default=1e-4, help='single-worker learning rate')
+    train_parser.add_argument('--augment', action='store_true')
+    train_parser.add_argument('--checkpoint', default='model_fcn_8s_distributed.h5')
+    train_parser.add_argument('--output', default='model_fcn8s_fin_distributed.h5')
+
+    measure_parser = commands.add_parser('measure', parents=[common], help='one timed run (under horovodrun)')
+    measure_parser.add_argument('--steps', type=int, default=30)
+    measure_parser.add_argument('--warmup', type=int, default=5)
+    measure_parser.add_argument('--result', required=True)
+
+    bench_parser = commands.add_parser('benchmark', parents=[common], help='images/s against worker count')
+    bench_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    bench_parser.add_argument('--steps', type=int, default=30)
+    bench_parser.add_argument('--warmup', type=int, default=5)
+    bench_parser.add_argument('--output', help='write the results as JSON to this file')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    if args.command == 'train':
+        train(args)
+    elif args.command == 'measure':
+        measure(args)
+    elif args.command == 'benchmark':
+        benchmark(args)
+    else:
+        build_parser().print_help()
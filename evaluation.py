@@ -0,0 +1,111 @@
+from multiprocessing import Pool
+
+import numpy as np
+
+import dataset_store
+from data_utils import classes
+
+
+class ConfusionMatrix(object):
+    '''Running n_classes x n_classes confusion matrix (rows are the true
+    class, columns the prediction).
+
+    Batches are folded in with a single bincount, so memory stays
+    O(n_classes**2) however many pixels are seen, and all the scores are
+    computed over the whole dataset rather than averaged over batches.
+    Pixels whose true label is >= n_classes (IGNORE_INDEX) are skipped.
+    '''
+
+    def __init__(self, n_classes=21):
+        self.n_classes = n_classes
+        self.matrix = np.zeros((n_classes, n_classes), dtype=np.int64)
+
+    def update(self, y_true, y_pred):
+        '''y_true holds class indices; y_pred either class indices of the same
+        shape or scores with an extra trailing class axis.
+        '''
+        y_true = np.asarray(y_true)
+        y_pred = np.asarray(y_pred)
+        if y_pred.ndim == y_true.ndim + 1:
+            y_pred = y_pred.argmax(axis=-1)
+        y_true = y_true.ravel().astype(np.int64)
+        y_pred = y_pred.ravel().astype(np.int64)
+
+        valid = y_true < self.n_classes
+        idx = y_true[valid] * self.n_classes + y_pred[valid]
+        self.matrix += np.bincount(idx, minlength=self.n_classes ** 2).reshape(self.n_classes, self.n_classes)
+        return self
+
+    def merge(self, other):
+        self.matrix += other.matrix if isinstance(other, ConfusionMatrix) else other
+        return self
+
+    def iou(self):
+        '''Per-class IoU, NaN for classes that appear in neither y_true nor y_pred.'''
+        tp = np.diag(self.matrix).astype(np.float64)
+        union = self.matrix.sum(axis=0) + self.matrix.sum(axis=1) - tp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return tp / union
+
+    def class_acc(self):
+        '''Per-class accuracy (recall), NaN for classes absent from y_true.'''
+        tp = np.diag(self.matrix).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return tp / self.matrix.sum(axis=1)
+
+    def mean_IoU(self):
+        return np.nanmean(self.iou())
+
+    def mean_acc(self):
+        return np.nanmean(self.class_acc())
+
+    def pixel_acc(self):
+        return np.diag(self.matrix).sum() / float(max(self.matrix.sum(), 1))
+
+    def report(self):
+        names = sorted(classes, key=classes.get)[:self.n_classes]
+        return {'mean_IoU': float(self.mean_IoU()),
+                'mean_acc': float(self.mean_acc()),
+                'pixel_acc': float(self.pixel_acc()),
+                'per_class_IoU': dict(zip(names, [float(v) for v in self.iou()]))}
+
+
+def evaluate_model(model, X, y, batch_size=8, n_classes=21, cm=None, rows=None):
+    '''Streams X through model.predict a batch at a time and accumulates the
+    confusion matrix against the label maps in y. rows restricts the
+    evaluation to those samples (e.g. class_index.ClassIndex.images_with).
+    '''
+    if cm is None:
+        cm = ConfusionMatrix(n_classes)
+    rows = np.arange(len(X)) if rows is None else np.sort(rows)
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        y_pred = model.predict(np.asarray(X[batch]), batch_size=batch_size)
+        cm.update(y[batch], y_pred)
+    return cm
+
+
+def _shard_matrix(args):
+    y_true_file, y_pred_file, start, stop, n_classes = args
+    y_true = dataset_store.open_array(y_true_file)
+    y_pred = dataset_store.open_array(y_pred_file)
+    return ConfusionMatrix(n_classes).update(y_true[start:stop], y_pred[start:stop]).matrix
+
+
+def evaluate_stored(y_true_file, y_pred_file, n_classes=21, processes=None, shard_size=256):
+    '''Scores stored label maps against stored predictions (both
+    dataset_store arrays). Shards are counted on a pool of worker processes
+    and their partial matrices merged.
+    '''
+    n = dataset_store.read_meta(y_true_file)['shape'][0]
+    shards = [(y_true_file, y_pred_file, start, min(start + shard_size, n), n_classes)
+              for start in range(0, n, shard_size)]
+    cm = ConfusionMatrix(n_classes)
+    pool = Pool(processes)
+    try:
+        for matrix in pool.imap_unordered(_shard_matrix, shards):
+            cm.merge(matrix)
+    finally:
+        pool.close()
+        pool.join()
+    return cm
@@ -0,0 +1,74 @@
+import hashlib
+import os
+
+import numpy as np
+
+import dataset_store
+from models import FCN8_TRUNK_OUTPUTS, fcn8_trunk
+
+
+def feature_files(prefix):
+    return ['%s_%s.npy' % (prefix, name) for name in FCN8_TRUNK_OUTPUTS]
+
+
+def trunk_weights_file(prefix):
+    return prefix + '_trunk.h5'
+
+
+def trunk_digest(model_8):
+    '''SHA-1 of the trunk weights of model_8. fc1 and fc2 are randomly
+    initialised by every build_fcn_models call, so features are only valid
+    for the exact weights they were computed with.
+    '''
+    digest = hashlib.sha1()
+    for w in fcn8_trunk(model_8).get_weights():
+        digest.update(np.ascontiguousarray(w).tobytes())
+    return digest.hexdigest()
+
+
+def load_trunk_weights(model_8, prefix):
+    '''Loads the trunk weights the features of prefix were computed with into
+    model_8, so the head trained on them and the saved model_8 match.
+    Returns False if there are none.
+    '''
+    filepath = trunk_weights_file(prefix)
+    if not os.path.exists(filepath):
+        return False
+    model_8.load_weights(filepath, by_name=True)
+    return True
+
+
+def is_current(X_file, prefix, model_8):
+    '''True if the feature store for prefix exists and was computed from the
+    current X_file with the current trunk weights of model_8.
+    '''
+    files = feature_files(prefix)
+    if not all(dataset_store.exists(f) for f in files):
+        return False
+    source_mtime = os.path.getmtime(X_file)
+    digest = trunk_digest(model_8)
+    return all(dataset_store.read_meta(f).get('source_mtime') == source_mtime
+               and dataset_store.read_meta(f).get('trunk_digest') == digest for f in files)
+
+
+def build_feature_store(model_8, X_file, prefix, batch_size=8, dtype=np.float16, n_classes=21):
+    '''Runs the frozen FCN-8s trunk once over X_file and stores its
+    block3_pool, block4_pool and fc2 outputs as memory-mapped arrays (one per
+    layer, float16 by default to halve the size), ready for training the
+    head with models.fcn8_head. The trunk weights are saved next to them
+    (load_trunk_weights).
+    '''
+    trunk = fcn8_trunk(model_8)
+    X = dataset_store.open_array(X_file)
+    n = len(X)
+    extra = {'source': X_file, 'source_mtime': os.path.getmtime(X_file), 'trunk_digest': trunk_digest(model_8)}
+    outs = [dataset_store.create_array(path, (n,) + tuple(shape[1:]), dtype, n_classes, layer=name, **extra)
+            for path, shape, name in zip(feature_files(prefix), trunk.output_shape, FCN8_TRUNK_OUTPUTS)]
+    for start in range(0, n, batch_size):
+        features = trunk.predict(np.asarray(X[start:start + batch_size]), batch_size=batch_size)
+        for out, f in zip(outs, features):
+            out[start:start + len(f)] = f
+    for out in outs:
+        out.flush()
+    trunk.save_weights(trunk_weights_file(prefix))
+    return feature_files(prefix)
@@ -0,0 +1,370 @@
+'''FCN-8s inference that starts fast.
+
+Importing this module only pulls in numpy and the standard library; keras,
+tensorflow and PIL are imported by the code paths that need them, and each
+model file is loaded once per process (get_model). Besides Keras .h5 files,
+get_model loads the int8 .tflite models written by quantize.py.
+
+    python inference.py --input JPEGImages/ --output masks/ [--tiled]
+'''
+import argparse
+import os
+from queue import Queue, Full
+from threading import Thread
+
+import numpy as np
+
+DEFAULT_MODEL = "model_fcn_8s_tran_init.h5"
+
+_models = {}
+# the TF graph each Keras model was loaded into; the default graph is thread
+# local in TF1, so predicting from another thread has to enter it
+_graphs = {}
+
+
+def takes_raw(model):
+    '''True for models built with raw_input=True, which preprocess in the graph.'''
+    if isinstance(model, TFLiteModel):
+        return model.input_details['dtype'] == np.uint8
+    return model is not None and any(layer.name == 'vgg_preprocess' for layer in model.layers)
+
+
+def preprocess(X, model=None):
+    '''VGG16 preprocessing of an RGB batch, or just a uint8 cast if model
+    does it itself.
+    '''
+    if takes_raw(model):
+        return np.asarray(X, dtype=np.uint8)
+    from keras.applications.vgg16 import preprocess_input
+    return preprocess_input(np.asarray(X, dtype=np.float32))
+
+
+def label_model(model):
+    '''Wraps a softmax FCN so the argmax runs in the graph and predict
+    returns (batch, h, w) uint8 label maps instead of float scores.
+    '''
+    import keras.backend as K
+    from keras.layers import Lambda
+    from keras.models import Model
+
+    labels = Lambda(lambda x: K.cast(K.argmax(x, axis=-1), 'uint8'), name='argmax_labels')(model.output)
+    return Model(model.input, labels)
+
+
+def score_model(model):
+    '''Drops the final softmax so predict returns the class scores (logits).'''
+    from keras.layers import Activation
+    from keras.models import Model
+
+    if isinstance(model.layers[-1], Activation):
+        return Model(model.input, model.layers[-2].output)
+    return model
+
+
+class TFLiteModel(object):
+    '''A .tflite model (see quantize.py) behind the predict(X, batch_size)
+    interface of a Keras model. It has no logits, so output='scores' gives
+    the softmax like output='softmax'; 'labels' argmaxes it to uint8.
+    '''
+
+    def __init__(self, filepath, output='labels'):
+        import tensorflow as tf
+
+        self.interpreter = tf.lite.Interpreter(model_path=filepath)
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.output = output
+        self.batch_size = None
+
+    def predict(self, X, batch_size=8, verbose=0):
+        results = []
+        for start in range(0, len(X), batch_size):
+            batch = np.asarray(X[start:start + batch_size], dtype=self.input_details['dtype'])
+            if len(batch) != self.batch_size:
+                self.interpreter.resize_tensor_input(self.input_details['index'], batch.shape)
+                self.interpreter.allocate_tensors()
+                self.batch_size = len(batch)
+            self.interpreter.set_tensor(self.input_details['index'], batch)
+            self.interpreter.invoke()
+            scores = self.interpreter.get_tensor(self.output_details['index'])
+            results.append(scores.argmax(axis=-1).astype(np.uint8) if self.output == 'labels' else scores)
+        return np.concatenate(results)
+
+
+def get_model(filepath=DEFAULT_MODEL, output='labels'):
+    '''Loads filepath once per process. output='labels' gives a label_model,
+    'scores' a score_model and 'softmax' the model as saved.
+    '''
+    key = (os.path.abspath(filepath), output)
+    if key not in _models and filepath.endswith('.tflite'):
+        _models[key] = TFLiteModel(filepath, output)
+    if key not in _models:
+        import tensorflow as tf
+        from keras.models import load_model
+        from metrics import custom_objects
+        import models  # registers image_softmax
+
+        # predicting needs no optimizer or metrics; the stateful
+        # SegmentationScore metrics of the training config cannot be
+        # deserialized by keras.metrics.get anyway
+        model = load_model(filepath, custom_objects=custom_objects, compile=False)
+        if output == 'labels':
+            model = label_model(model)
+        elif output == 'scores':
+            model = score_model(model)
+        # Keras builds the predict function lazily; build it here, in the graph
+        # the model was loaded into, not on the first predict's thread
+        model._make_predict_function()
+        _models[key] = model
+        _graphs[key] = tf.get_default_graph()
+    return _models[key]
+
+
+def model_predict(model, X, filepath=DEFAULT_MODEL, output='labels', **kwargs):
+    '''model.predict on any thread: runs in the graph get_model loaded the
+    model into.
+    '''
+    graph = _graphs.get((os.path.abspath(filepath), output))
+    if graph is None:
+        return model.predict(X, **kwargs)
+    with graph.as_default():
+        return model.predict(X, **kwargs)
+
+
+def predict(images, filepath=DEFAULT_MODEL, batch_size=8):
+    '''Segments a (batch, 224, 224, 3) RGB batch, returns uint8 label maps.'''
+    model = get_model(filepath)
+    return model_predict(model, preprocess(images, model), filepath, batch_size=batch_size)
+
+
+def check_overlap(tile_size, overlap):
+    '''Tiles must overlap by 0 or more pixels and still advance.'''
+    if not 0 <= overlap < min(tile_size):
+        raise ValueError('tile overlap must be in [0, %d) for %s tiles, got %r'
+                         % (min(tile_size), 'x'.join(str(t) for t in tile_size), overlap))
+
+
+def tile_starts(length, tile, stride):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def blend_window(tile_size):
+    '''Weights that fall off towards the tile border, so overlapping tiles
+    blend smoothly instead of leaving seams.
+    '''
+    win_h = np.hanning(tile_size[0] + 2)[1:-1]
+    win_w = np.hanning(tile_size[1] + 2)[1:-1]
+    return np.outer(win_h, win_w).astype(np.float32)[..., np.newaxis]
+
+
+def predict_tiled(model, img, tile_size=(224, 224), overlap=64, batch_size=8):
+    '''Segments an H x W x 3 RGB image of any size with a fixed input size
+    model (see score_model) by cutting it into overlapping tiles.
+
+    The tiles of one tile-row are batched through the model (batch_size at a
+    time) and their window-weighted scores are added into a band that is only
+    tile_size[0] rows high; rows are argmaxed into the uint8 result as soon
+    as no later tile covers them. Peak memory is therefore one band plus one
+    batch of tiles, whatever the image size.
+    '''
+    check_overlap(tile_size, overlap)
+    th, tw = tile_size
+    img = np.asarray(img, dtype=np.float32)
+    H, W = img.shape[:2]
+    if H < th or W < tw:
+        img = np.pad(img, ((0, max(th - H, 0)), (0, max(tw - W, 0)), (0, 0)), mode='edge')
+    PH, PW = img.shape[:2]
+
+    ys = tile_starts(PH, th, th - overlap)
+    xs = tile_starts(PW, tw, tw - overlap)
+    window = blend_window(tile_size)
+    labels = np.empty((PH, PW), dtype=np.uint8)
+    band = None
+    band_top = 0
+
+    for y in ys:
+        shift = y - band_top
+        if shift:
+            # rows above y are complete, no later tile overlaps them
+            labels[band_top:y] = band[:shift].argmax(axis=-1)
+            band[:-shift] = band[shift:]
+            band[-shift:] = 0
+            band_top = y
+        for start in range(0, len(xs), batch_size):
+            batch_xs = xs[start:start + batch_size]
+            X = preprocess(np.stack([img[y:y + th, x:x + tw] for x in batch_xs]), model)
+            scores = model.predict(X, batch_size=batch_size)
+            if band is None:
+                band = np.zeros((th, PW, scores.shape[-1]), dtype=np.float32)
+            for x, tile_scores in zip(batch_xs, scores):
+                band[:, x:x + tw] += tile_scores * window
+    labels[band_top:] = band[:PH - band_top].argmax(axis=-1)
+
+    return labels[:H, :W]
+
+
+def list_inputs(input_path, X_path=None, X_ext='.jpg'):
+    '''An input directory gives all the images in it; a text file gives one
+    image per line, either a path or a VOC style base name under X_path.
+    '''
+    from data_utils import read_file_list
+
+    if os.path.isdir(input_path):
+        return sorted(os.path.join(input_path, f) for f in os.listdir(input_path)
+                      if os.path.splitext(f)[1].lower() in ('.jpg', '.jpeg', '.png', '.bmp'))
+    paths = []
+    for name in read_file_list(input_path):
+        if not os.path.isfile(name) and X_path is not None:
+            name = os.path.join(X_path, name) + X_ext
+        paths.append(name)
+    return paths
+
+
+def load_batch(paths, target_size=(224, 224), model=None):
+    from PIL import Image
+
+    sizes = []
+    X = np.empty((len(paths),) + tuple(target_size) + (3,), dtype=np.float32)
+    for i, path in enumerate(paths):
+        img = Image.open(path).convert('RGB')
+        sizes.append(img.size)
+        X[i] = np.asarray(img.resize((target_size[1], target_size[0]), Image.NEAREST), dtype=np.float32)
+    return preprocess(X, model), sizes
+
+
+def write_masks(queue, output_dir, restore_size):
+    from PIL import Image
+    from data_utils import labels_to_images, palette
+
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        paths, sizes, labels = item
+        for path, size, img in zip(paths, sizes, labels_to_images(labels, palette)):
+            if restore_size and img.size != size:
+                img = img.resize(size, Image.NEAREST)
+            name = os.path.splitext(os.path.basename(path))[0] + '.png'
+            img.save(os.path.join(output_dir, name))
+
+
+class MaskWriter(object):
+    '''Runs write_masks on a background thread with at most max_pending
+    batches waiting. If writing fails (disk full, bad path) the error is
+    raised again by the next put or by close instead of leaving the caller
+    blocked on a queue nobody reads.
+    '''
+
+    def __init__(self, output_dir, restore_size, max_pending=2):
+        self.queue = Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = Thread(target=self._run, args=(output_dir, restore_size))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, output_dir, restore_size):
+        try:
+            write_masks(self.queue, output_dir, restore_size)
+        except Exception as e:
+            self.error = e
+
+    def _put(self, item):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def put(self, paths, sizes, labels):
+        if not self._put((paths, sizes, labels)):
+            self.close()
+
+    def close(self):
+        '''Waits until everything queued is written.'''
+        self._put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def predict_to_disk(model, paths, output_dir, batch_size=8, restore_size=True, max_pending=2):
+    '''Segments every image in paths and writes palettized PNG masks to
+    output_dir. model must return label maps (see label_model). A writer
+    thread saves one batch while the next is computed, and at most
+    max_pending batches wait for it, so memory does not grow with the number
+    of images.
+    '''
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    writer = MaskWriter(output_dir, restore_size, max_pending)
+    try:
+        for start in range(0, len(paths), batch_size):
+            batch_paths = paths[start:start + batch_size]
+            X, sizes = load_batch(batch_paths, model=model)
+            labels = model.predict(X, batch_size=batch_size)
+            writer.put(batch_paths, sizes, labels)
+            print('%d/%d' % (start + len(batch_paths), len(paths)))
+    finally:
+        writer.close()
+
+
+def predict_tiled_to_disk(model, paths, output_dir, tile_size=(224, 224), overlap=64, batch_size=8,
+                          max_pending=2):
+    '''Like predict_to_disk, but every image is segmented at its full
+    resolution with predict_tiled. model should return scores (see
+    score_model).
+    '''
+    from PIL import Image
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    check_overlap(tile_size, overlap)
+    writer = MaskWriter(output_dir, False, max_pending)
+    try:
+        for i, path in enumerate(paths):
+            img = Image.open(path).convert('RGB')
+            labels = predict_tiled(model, img, tile_size, overlap, batch_size)
+            writer.put([path], [img.size], labels[np.newaxis])
+            print('%d/%d' % (i + 1, len(paths)))
+    finally:
+        writer.close()
+
+
+def build_parser():
+    root = os.getcwd()
+    parser = argparse.ArgumentParser(description='Segment images with a trained FCN-8s model.')
+    parser.add_argument('--model', default=os.path.join(root, DEFAULT_MODEL))
+    parser.add_argument('--input', help='image directory or text file listing images')
+    parser.add_argument('--output', default='masks', help='directory for the PNG masks')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--X-path', default=root + "/JPEGImages/",
+                        help='where base names from a list file are looked up')
+    parser.add_argument('--model-size', action='store_true',
+                        help='write masks at the 224x224 model resolution instead of the input size')
+    parser.add_argument('--tiled', action='store_true',
+                        help='segment each image at full resolution with overlapping 224x224 tiles')
+    parser.add_argument('--tile-overlap', type=int, default=64)
+    return parser
+
+
+def run(args):
+    paths = list_inputs(args.input, args.X_path)
+    if args.tiled:
+        predict_tiled_to_disk(get_model(args.model, 'scores'), paths, args.output,
+                              overlap=args.tile_overlap, batch_size=args.batch_size)
+    else:
+        predict_to_disk(get_model(args.model, 'labels'), paths, args.output, batch_size=args.batch_size,
+                        restore_size=not args.model_size)
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    if args.input is None:
+        build_parser().error('--input is required')
+    run(args)
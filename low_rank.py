@@ -0,0 +1,182 @@
+'''Low-rank factorization of the fc1 / fc2 layers of a trained FCN-8s.
+
+fc1 (7x7x512 -> 4096, ~103M weights) and fc2 (1x1 4096 -> 4096, ~17M) are
+replaced by chains of smaller convolutions (models.low_rank_conv) whose
+weights come from a truncated SVD / Tucker decomposition of the trained
+kernels, so the result is close to the original model before any training:
+
+  svd      fc1 = 7x7 conv to rank, 1x1 to 4096
+  spatial  fc1 = 7x1 conv to rank, 1x7 to 4096
+  tucker   fc1 = 1x1 to r_in, 7x7 r_in -> r_out, 1x1 to 4096
+
+fc2 is always split by SVD. Optionally the factorized model is fine-tuned
+for a few epochs (VGG16 conv blocks frozen). The report lists parameter
+counts, the share of the kernel energy kept, latency and mIoU on
+X_fin_test for the original, factorized and fine-tuned models.
+
+    python low_rank.py --model model_fcn_8s_tran_init.h5 --fc1-rank 512 --fc2-rank 1024 \\
+        --finetune-epochs 1 --output model_fcn_8s_lowrank.h5 --report lowrank.json
+'''
+import argparse
+
+import numpy as np
+
+from benchmarking import predict_latency, write_report
+
+
+def truncated_svd(M, rank):
+    '''Top rank singular triplets of M through the eigendecomposition of the
+    smaller Gram matrix (M is up to 25088 x 4096). Returns U, s, Vt and the
+    fraction of the squared Frobenius norm they keep.
+    '''
+    M = np.asarray(M, dtype=np.float64)
+    transpose = M.shape[0] < M.shape[1]
+    if transpose:
+        M = M.T
+    eigvals, V = np.linalg.eigh(M.T.dot(M))
+    order = np.argsort(eigvals)[::-1][:rank]
+    s = np.sqrt(np.maximum(eigvals[order], 0))
+    V = V[:, order]
+    U = M.dot(V) / np.maximum(s, 1e-12)
+    energy = float(np.sum(s ** 2) / max(np.sum(eigvals), 1e-12))
+    if transpose:
+        return V, s, U.T, energy
+    return U, s, V.T, energy
+
+
+def svd_factors(kernel, bias, rank):
+    '''(kh, kw, cin, cout) -> kh x kw conv to rank channels and a 1x1 conv.'''
+    kh, kw, cin, cout = kernel.shape
+    U, s, Vt, energy = truncated_svd(kernel.reshape(kh * kw * cin, cout), rank)
+    a = (U * np.sqrt(s)).reshape(kh, kw, cin, rank)
+    b = (np.sqrt(s)[:, np.newaxis] * Vt).reshape(1, 1, rank, cout)
+    return [[a], [b, bias]], energy
+
+
+def spatial_factors(kernel, bias, rank):
+    '''(kh, kw, cin, cout) -> (kh, 1) conv to rank channels and a (1, kw) conv.'''
+    kh, kw, cin, cout = kernel.shape
+    U, s, Vt, energy = truncated_svd(kernel.transpose(0, 2, 1, 3).reshape(kh * cin, kw * cout), rank)
+    a = (U * np.sqrt(s)).reshape(kh, 1, cin, rank)
+    b = (np.sqrt(s)[:, np.newaxis] * Vt).reshape(rank, kw, cout).transpose(1, 0, 2)[np.newaxis]
+    return [[a], [b, bias]], energy
+
+
+def tucker_factors(kernel, bias, ranks):
+    '''Tucker-2 (HOSVD) over the channel modes: a 1x1 conv to r_in, the
+    kh x kw core r_in -> r_out and a 1x1 conv to cout.
+    '''
+    r_in, r_out = ranks
+    kh, kw, cin, cout = kernel.shape
+    U_in = truncated_svd(kernel.transpose(2, 0, 1, 3).reshape(cin, -1), r_in)[0]
+    U_out = truncated_svd(kernel.reshape(-1, cout).T, r_out)[0]
+    core = np.einsum('hwco,ci,oj->hwij', kernel, U_in, U_out)
+    energy = float(np.sum(core ** 2) / np.sum(np.asarray(kernel, dtype=np.float64) ** 2))
+    return [[U_in[np.newaxis, np.newaxis]], [core], [U_out.T[np.newaxis, np.newaxis], bias]], energy
+
+
+FACTORS = {'svd': svd_factors, 'spatial': spatial_factors, 'tucker': tucker_factors}
+
+
+def convert_weights(src, dst, fc1_rank=None, fc2_rank=None, fc1_method='svd'):
+    '''Copies every layer of src into the factorized dst by name and fills
+    dst's fc1_* / fc2_* layers with the factors of src's fc1 / fc2. Returns
+    the kept energy of each factorized layer.
+    '''
+    dst_names = set(layer.name for layer in dst.layers)
+    for layer in src.layers:
+        if layer.name in dst_names and layer.get_weights():
+            dst.get_layer(layer.name).set_weights(layer.get_weights())
+
+    energy = {}
+    for name, rank, method in (('fc1', fc1_rank, fc1_method), ('fc2', fc2_rank, 'svd')):
+        if rank is None:
+            continue
+        kernel, bias = src.get_layer(name).get_weights()
+        factors, energy[name] = FACTORS[method](kernel, bias, rank)
+        for suffix, weights in zip('abc', factors):
+            dst.get_layer('%s_%s' % (name, suffix)).set_weights([w.astype(np.float32) for w in weights])
+    return energy
+
+
+def fc_params(model):
+    '''Weights in the fc1 / fc2 layers (or their factors) of model.'''
+    return dict((name, int(sum(layer.count_params() for layer in model.layers
+                               if layer.name == name or layer.name.startswith(name + '_'))))
+                for name in ('fc1', 'fc2'))
+
+
+def finetune(model_8, epochs, steps_per_epoch=None, batch_size=1, lr=1e-4):
+    '''Trains the factorized model on X_train.npy with the VGG16 conv blocks
+    frozen, as train.py does for FCN-8s.
+    '''
+    from keras.optimizers import SGD
+    from data_generator import SegmentationSequence
+    from metrics import sparse_fcn_xent_nobg, sparse_mean_IoU
+
+    for layer in model_8.layers:
+        layer.trainable = not layer.name.startswith(('block', 'input'))
+    model_8.compile(loss=sparse_fcn_xent_nobg, optimizer=SGD(lr=lr, momentum=0.9), metrics=[sparse_mean_IoU])
+    train_seq = SegmentationSequence("X_train.npy", "y_train.npy", batch_size=batch_size, shuffle=True)
+    model_8.fit_generator(train_seq, steps_per_epoch=steps_per_epoch, epochs=epochs, verbose=1)
+
+
+def report(name, model, X, y, batch_sizes=(1, 8)):
+    from evaluation import evaluate_model
+
+    cm = evaluate_model(model, X, y)
+    result = {'params': int(model.count_params()), 'fc_params': fc_params(model),
+              'mean_IoU': cm.mean_IoU(), 'pixel_acc': cm.pixel_acc()}
+    for batch_size in batch_sizes:
+        result['latency_batch_%d_s' % batch_size] = predict_latency(model, X, batch_size)
+    print(name, result)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='model_fcn_8s_tran_init.h5', help='full-rank FCN-8s checkpoint')
+    parser.add_argument('--fc1-rank', type=int, nargs='+', help='one rank, or r_in r_out for tucker')
+    parser.add_argument('--fc1-method', default='svd', choices=sorted(FACTORS))
+    parser.add_argument('--fc2-rank', type=int)
+    parser.add_argument('--finetune-epochs', type=int, default=0)
+    parser.add_argument('--finetune-steps', type=int, help='batches per fine-tuning epoch (default: all)')
+    parser.add_argument('--X', default='X_fin_test.npy')
+    parser.add_argument('--y', default='y_fin_test.npy')
+    parser.add_argument('--n-eval', type=int, default=200)
+    parser.add_argument('--output', help='save the factorized model here')
+    parser.add_argument('--report', help='write the comparison as JSON to this file')
+    args = parser.parse_args()
+
+    import dataset_store
+    from models import build_fcn_models
+
+    fc1_rank = args.fc1_rank
+    if fc1_rank is not None:
+        fc1_rank = tuple(fc1_rank) if args.fc1_method == 'tucker' else fc1_rank[0]
+
+    _, _, original = build_fcn_models(weights=None)
+    original.load_weights(args.model, by_name=True)
+    _, _, factorized = build_fcn_models(weights=None, fc1_rank=fc1_rank, fc2_rank=args.fc2_rank,
+                                        fc1_method=args.fc1_method)
+    energy = convert_weights(original, factorized, fc1_rank, args.fc2_rank, args.fc1_method)
+
+    X = np.asarray(dataset_store.open_array(args.X)[:args.n_eval])
+    y = np.asarray(dataset_store.open_array(args.y)[:args.n_eval])
+    results = {'config': {'model': args.model, 'fc1_rank': fc1_rank, 'fc1_method': args.fc1_method,
+                          'fc2_rank': args.fc2_rank, 'finetune_epochs': args.finetune_epochs},
+               'energy_kept': energy,
+               'original': report('original', original, X, y),
+               'factorized': report('factorized', factorized, X, y)}
+    if args.finetune_epochs:
+        finetune(factorized, args.finetune_epochs, args.finetune_steps)
+        results['finetuned'] = report('finetuned', factorized, X, y)
+    for key in ('factorized', 'finetuned'):
+        if key in results:
+            results[key]['speedup_batch_1'] = (results['original']['latency_batch_1_s']
+                                               / results[key]['latency_batch_1_s'])
+            results[key]['mean_IoU_delta'] = results[key]['mean_IoU'] - results['original']['mean_IoU']
+
+    if args.output:
+        factorized.save(args.output)
+    write_report(results, args.report)
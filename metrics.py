@@ -0,0 +1,207 @@
+import numpy as np
+import keras.backend as K
+import tensorflow as tf
+from keras.engine import Layer
+
+
+def pixel_acc(y_true, y_pred):
+	s = K.shape(y_true)
+
+	# reshape such that w and h dim are multiplied together
+	y_true_reshaped = K.reshape( y_true, tf.stack( [-1, s[1]*s[2], s[-1]] ) )
+	y_pred_reshaped = K.reshape( y_pred, tf.stack( [-1, s[1]*s[2], s[-1]] ) )
+
+	# correctly classified
+	clf_pred = K.one_hot( K.argmax(y_pred_reshaped), num_classes = s[-1])
+	correct_pixels_per_class = K.cast( K.equal(clf_pred,y_true_reshaped), dtype='float32')
+
+	return K.sum(correct_pixels_per_class) / K.cast(K.prod(s), dtype='float32')
+
+def mean_acc(y_true, y_pred):
+	s = K.shape(y_true)
+
+	# reshape such that w and h dim are multiplied together
+	y_true_reshaped = K.reshape( y_true, tf.stack( [-1, s[1]*s[2], s[-1]] ) )
+	y_pred_reshaped = K.reshape( y_pred, tf.stack( [-1, s[1]*s[2], s[-1]] ) )
+
+	# correctly classified
+	clf_pred = K.one_hot( K.argmax(y_pred_reshaped), num_classes = s[-1])
+	equal_entries = K.cast(K.equal(clf_pred,y_true_reshaped), dtype='float32') * y_true_reshaped
+
+	correct_pixels_per_class = K.sum(equal_entries, axis=1)
+	n_pixels_per_class = K.sum(y_true_reshaped,axis=1)
+
+	acc = correct_pixels_per_class / n_pixels_per_class
+	acc_mask = tf.is_finite(acc)
+	acc_masked = tf.boolean_mask(acc,acc_mask)
+
+	return K.mean(acc_masked)
+
+def mean_IoU(y_true, y_pred):
+    s = K.shape(y_true)
+
+    # reshape such that w and h dim are multiplied together
+    y_true_reshaped = K.reshape(y_true, tf.stack([-1, s[1] * s[2], s[-1]]))
+    y_pred_reshaped = K.reshape(y_pred, tf.stack([-1, s[1] * s[2], s[-1]]))
+
+    # correctly classified
+    clf_pred = K.one_hot(K.argmax(y_pred_reshaped), num_classes=s[-1])
+    equal_entries = K.cast(K.equal(clf_pred, y_true_reshaped), dtype='float32') * y_true_reshaped
+
+    intersection = K.sum(equal_entries, axis=1)
+    union_per_class = K.sum(y_true_reshaped, axis=1) + K.sum(y_pred_reshaped, axis=1)
+
+    iou = intersection / (union_per_class - intersection)
+    iou_mask = tf.is_finite(iou)
+    iou_masked = tf.boolean_mask(iou, iou_mask)
+
+    return K.mean(iou_masked)
+
+def fcn_xent_nobg(y_true, y_pred):
+	y_true = y_true[:,:,:,1:]
+	y_pred = y_pred[:,:,:,1:]
+
+	y_true_reshaped = K.flatten(y_true)
+	y_pred_reshaped = K.flatten(y_pred)
+
+	return K.binary_crossentropy(y_pred_reshaped, y_true_reshaped)
+
+
+# Sparse variants: y_true holds uint8 class indices of shape (batch, h, w, 1)
+# instead of a one-hot tensor. The one-hot encoding happens per batch inside
+# the graph, and pixels labelled with data_utils.IGNORE_INDEX become all-zero
+# rows, so the results are the same as the dense metrics on one-hot targets.
+
+def sparse_to_one_hot(y_true, n_classes):
+    labels = K.cast(y_true[:, :, :, 0], 'int32')
+    return K.one_hot(labels, n_classes)
+
+
+def sparse_pixel_acc(y_true, y_pred):
+    return pixel_acc(sparse_to_one_hot(y_true, K.int_shape(y_pred)[-1]), y_pred)
+
+
+def sparse_mean_acc(y_true, y_pred):
+    return mean_acc(sparse_to_one_hot(y_true, K.int_shape(y_pred)[-1]), y_pred)
+
+
+def sparse_mean_IoU(y_true, y_pred):
+    return mean_IoU(sparse_to_one_hot(y_true, K.int_shape(y_pred)[-1]), y_pred)
+
+
+def sparse_fcn_xent_nobg(y_true, y_pred):
+    return fcn_xent_nobg(sparse_to_one_hot(y_true, K.int_shape(y_pred)[-1]), y_pred)
+
+
+# Fused stateful metrics: one argmax and one confusion matrix per batch, added
+# to a running total that Keras resets at the start of every epoch and of
+# every evaluation. The scores are read off the total, so the epoch values
+# are dataset-level (as evaluation.ConfusionMatrix), not batch averages.
+
+def batch_confusion_matrix(y_true, y_pred, n_classes, sparse=True):
+    '''int64 n_classes x n_classes matrix of one batch (rows are the true
+    class). y_true holds class indices (batch, h, w, 1) if sparse, else
+    one-hot rows; ignored pixels (>= n_classes, or all-zero rows) are left out.
+    '''
+    if sparse:
+        labels = K.reshape(K.cast(y_true, 'int64'), [-1])
+        valid = K.less(labels, n_classes)
+    else:
+        y_true = K.reshape(y_true, [-1, n_classes])
+        labels = K.argmax(y_true, axis=-1)
+        valid = K.greater(K.sum(y_true, axis=-1), 0)
+    predictions = K.reshape(K.argmax(y_pred, axis=-1), [-1])
+    return tf.confusion_matrix(tf.boolean_mask(labels, valid), tf.boolean_mask(predictions, valid),
+                               num_classes=n_classes, dtype=tf.int64)
+
+
+def score_from_matrix(matrix, score):
+    '''mean_IoU, mean_acc or pixel_acc of a confusion matrix tensor; classes
+    with an empty denominator are left out of the means.
+    '''
+    matrix = K.cast(matrix, 'float64')
+    tp = tf.diag_part(matrix)
+    if score == 'pixel_acc':
+        return K.cast(K.sum(tp) / K.maximum(K.sum(matrix), 1.), 'float32')
+    if score == 'mean_IoU':
+        denominator = K.sum(matrix, axis=0) + K.sum(matrix, axis=1) - tp
+    elif score == 'mean_acc':
+        denominator = K.sum(matrix, axis=1)
+    else:
+        raise ValueError('unknown score %r' % score)
+    present = K.greater(denominator, 0)
+    return K.cast(K.mean(tf.boolean_mask(tp, present) / tf.boolean_mask(denominator, present)), 'float32')
+
+
+class RunningConfusionMatrix(object):
+    '''Confusion matrix variable shared by several SegmentationScore
+    metrics. The batch matrix is built and added once per (y_true, y_pred)
+    pair, however many scores read it.
+
+    reduce, if given, maps the running matrix to the one the scores are
+    computed from, e.g. a sum over data-parallel workers.
+    '''
+
+    def __init__(self, n_classes=21, sparse=True, reduce=None):
+        self.n_classes = n_classes
+        self.sparse = sparse
+        self.reduce = reduce
+        self.matrix = K.variable(np.zeros((n_classes, n_classes), dtype=np.int64), dtype='int64', name='confusion_matrix')
+        self._totals = {}
+
+    def reset(self):
+        K.set_value(self.matrix, np.zeros((self.n_classes, self.n_classes), dtype=np.int64))
+
+    def total(self, y_true, y_pred):
+        '''The running matrix after adding this batch (an update op, reduced
+        if reduce is set).
+        '''
+        key = (y_true, y_pred)
+        if key not in self._totals:
+            batch = batch_confusion_matrix(y_true, y_pred, self.n_classes, self.sparse)
+            total = K.update_add(self.matrix, batch)
+            self._totals[key] = total if self.reduce is None else self.reduce(total)
+        return self._totals[key]
+
+
+class SegmentationScore(Layer):
+    '''Stateful Keras metric reporting score (mean_IoU, mean_acc or
+    pixel_acc) of everything seen since the last reset. Use
+    segmentation_metrics() to get all three on one shared matrix.
+    '''
+
+    def __init__(self, score='mean_IoU', n_classes=21, sparse=True, confusion=None, **kwargs):
+        kwargs.setdefault('name', score)
+        super(SegmentationScore, self).__init__(**kwargs)
+        self.stateful = True
+        self.score = score
+        self.confusion = confusion or RunningConfusionMatrix(n_classes, sparse)
+
+    def reset_states(self):
+        self.confusion.reset()
+
+    def __call__(self, y_true, y_pred):
+        total = self.confusion.total(y_true, y_pred)
+        self.add_update(total, inputs=[y_true, y_pred])
+        return score_from_matrix(total, self.score)
+
+    def get_config(self):
+        config = {'score': self.score, 'n_classes': self.confusion.n_classes, 'sparse': self.confusion.sparse}
+        base_config = super(SegmentationScore, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def segmentation_metrics(n_classes=21, sparse=True, reduce=None):
+    '''[mean_IoU, mean_acc, pixel_acc] metrics sharing one confusion matrix,
+    for model.compile(metrics=...). Every compiled model needs its own.
+    '''
+    confusion = RunningConfusionMatrix(n_classes, sparse, reduce)
+    return [SegmentationScore(score, confusion=confusion) for score in ('mean_IoU', 'mean_acc', 'pixel_acc')]
+
+
+# for load_model(..., custom_objects=custom_objects)
+custom_objects = {'pixel_acc': pixel_acc, 'mean_acc': mean_acc, 'mean_IoU': mean_IoU,
+                  'fcn_xent_nobg': fcn_xent_nobg,
+                  'sparse_pixel_acc': sparse_pixel_acc, 'sparse_mean_acc': sparse_mean_acc,
+                  'sparse_mean_IoU': sparse_mean_IoU, 'sparse_fcn_xent_nobg': sparse_fcn_xent_nobg,
+                  'SegmentationScore': SegmentationScore}
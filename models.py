@@ -0,0 +1,463 @@
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+from keras.applications.vgg16 import VGG16
+from keras.engine import Layer, InputSpec
+from keras.layers import Activation, Conv2D, Dropout, Input, Add, Average, Lambda, UpSampling2D
+from keras.models import Model
+from keras.utils.generic_utils import get_custom_objects
+from keras import regularizers
+
+from data_utils import VGG_MEAN_BGR
+
+
+def image_softmax(input):
+    label_dim = -1
+    d = K.exp(input - K.max(input, axis=label_dim, keepdims=True))
+    return d / K.sum(d, axis=label_dim, keepdims=True)
+
+
+def vgg_preprocess(x):
+    '''keras.applications.vgg16.preprocess_input in the graph: uint8 RGB to
+    mean-subtracted float BGR.
+    '''
+    x = K.cast(x, 'float32')[..., ::-1]
+    return x - K.constant(VGG_MEAN_BGR)
+
+
+#### Image Upsampling ########
+def _scaled_dim(dim, factor):
+    # static spatial dimensions may be unknown (None), they stay unknown
+    return None if dim is None else dim * factor
+
+
+def resize_images_bilinear(X, height_factor=1, width_factor=1, target_height=None, target_width=None, data_format='default'):
+    '''Resizes the images contained in a 4D tensor of shape
+    - [batch, channels, height, width] (for 'channels_first' data_format)
+    - [batch, height, width, channels] (for 'channels_last' data_format)
+    by a factor of (height_factor, width_factor). Both factors should be
+    positive integers.
+    '''
+    if data_format == 'default':
+        data_format = K.image_data_format()
+    if data_format == 'channels_first':
+        original_shape = K.int_shape(X)
+        if target_height and target_width:
+            new_shape = tf.constant(np.array((target_height, target_width)).astype('int32'))
+        else:
+            new_shape = tf.shape(X)[2:]
+            new_shape *= tf.constant(np.array([height_factor, width_factor]).astype('int32'))
+        X = K.permute_dimensions(X, [0, 2, 3, 1])
+        X = tf.image.resize_bilinear(X, new_shape)
+        X = K.permute_dimensions(X, [0, 3, 1, 2])
+        if target_height and target_width:
+            X.set_shape((None, None, target_height, target_width))
+        else:
+            X.set_shape((None, None, _scaled_dim(original_shape[2], height_factor),
+                         _scaled_dim(original_shape[3], width_factor)))
+        return X
+    elif data_format == 'channels_last':
+        original_shape = K.int_shape(X)
+        if target_height and target_width:
+            new_shape = tf.constant(np.array((target_height, target_width)).astype('int32'))
+        else:
+            new_shape = tf.shape(X)[1:3]
+            new_shape *= tf.constant(np.array([height_factor, width_factor]).astype('int32'))
+        X = tf.image.resize_bilinear(X, new_shape)
+        if target_height and target_width:
+            X.set_shape((None, target_height, target_width, None))
+        else:
+            X.set_shape((None, _scaled_dim(original_shape[1], height_factor),
+                         _scaled_dim(original_shape[2], width_factor), None))
+        return X
+    else:
+        raise Exception('Invalid data_format: ' + data_format)
+
+class BilinearUpSampling2D(Layer):
+    def __init__(self, size=(1, 1), target_size=None, data_format='default', **kwargs):
+        # Layer.__init__ resets input_spec, so it has to run first
+        super(BilinearUpSampling2D, self).__init__(**kwargs)
+        if data_format == 'default':
+            data_format = K.image_data_format()
+        self.size = tuple(size)
+        if target_size is not None:
+            self.target_size = tuple(target_size)
+        else:
+            self.target_size = None
+        assert data_format in {'channels_last', 'channels_first'}, 'data_format must be in {tf, th}'
+        self.data_format = data_format
+        self.input_spec = [InputSpec(ndim=4)]
+
+    def compute_output_shape(self, input_shape):
+        if self.data_format == 'channels_first':
+            width = int(self.size[0] * input_shape[2]) if input_shape[2] is not None else None
+            height = int(self.size[1] * input_shape[3]) if input_shape[3] is not None else None
+            if self.target_size is not None:
+                width = self.target_size[0]
+                height = self.target_size[1]
+            return (input_shape[0],
+                    input_shape[1],
+                    width,
+                    height)
+        elif self.data_format == 'channels_last':
+            width = int(self.size[0] * input_shape[1]) if input_shape[1] is not None else None
+            height = int(self.size[1] * input_shape[2]) if input_shape[2] is not None else None
+            if self.target_size is not None:
+                width = self.target_size[0]
+                height = self.target_size[1]
+            return (input_shape[0],
+                    width,
+                    height,
+                    input_shape[3])
+        else:
+            raise Exception('Invalid data_format: ' + self.data_format)
+
+    def call(self, x, mask=None):
+        if self.target_size is not None:
+            return resize_images_bilinear(x, target_height=self.target_size[0], target_width=self.target_size[1], data_format=self.data_format)
+        else:
+            return resize_images_bilinear(x, height_factor=self.size[0], width_factor=self.size[1], data_format=self.data_format)
+
+    def get_config(self):
+        config = {'size': self.size, 'target_size': self.target_size}
+        base_config = super(BilinearUpSampling2D, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+get_custom_objects().update({'image_softmax': Activation(image_softmax),
+                             'vgg_preprocess': vgg_preprocess,
+                             'BilinearUpSampling2D': BilinearUpSampling2D})
+
+
+@contextmanager
+def floatx(dtype):
+    '''Layers built inside the block create their weights as dtype.'''
+    old = K.floatx()
+    if dtype is not None:
+        K.set_floatx(dtype)
+    try:
+        yield
+    finally:
+        K.set_floatx(old)
+
+
+def cast(x, dtype, name):
+    '''Casts x to dtype with a layer named name_dtype; no-op for dtype None.'''
+    if dtype is None:
+        return x
+    return Lambda(lambda t: K.cast(t, dtype), name='%s_%s' % (name, dtype))(x)
+
+
+def low_rank_conv(x, filters, kernel_size, rank, method, activation, name):
+    '''A Conv2D(filters, kernel_size) replaced by a chain of cheaper
+    convolutions (weights from low_rank.py):
+
+      'svd'      kernel_size conv to rank channels, then 1x1 to filters
+      'spatial'  (kh, 1) conv to rank channels, then (1, kw) to filters
+      'tucker'   rank = (r_in, r_out): 1x1 to r_in, kernel_size conv to
+                 r_out, then 1x1 to filters
+
+    The layers are named name_a, name_b (and name_c); only the last has a
+    bias and the activation.
+    '''
+    kh, kw = kernel_size
+    if method == 'svd':
+        x = Conv2D(rank, kernel_size, padding='same', use_bias=False, name=name + '_a')(x)
+        last = Conv2D(filters, (1, 1), activation=activation, padding='same', name=name + '_b')
+    elif method == 'spatial':
+        x = Conv2D(rank, (kh, 1), padding='same', use_bias=False, name=name + '_a')(x)
+        last = Conv2D(filters, (1, kw), activation=activation, padding='same', name=name + '_b')
+    elif method == 'tucker':
+        x = Conv2D(rank[0], (1, 1), padding='same', use_bias=False, name=name + '_a')(x)
+        x = Conv2D(rank[1], kernel_size, padding='same', use_bias=False, name=name + '_b')(x)
+        last = Conv2D(filters, (1, 1), activation=activation, padding='same', name=name + '_c')
+    else:
+        raise ValueError('unknown factorization %r' % method)
+    return last(x)
+
+
+def upsample(x, size, name, upsampling='nearest'):
+    if upsampling == 'bilinear':
+        return BilinearUpSampling2D(size=(size, size), name=name)(x)
+    return UpSampling2D(size = (size,size), name = name)(x)
+
+
+def upsample_score(x, size, name, conv, decoder='full', upsampling='nearest'):
+    '''Upsamples x by size and applies the 1x1 conv. decoder='coarse' applies
+    the conv first: both upsamplings are per-channel weighted averages, so
+    the result is the same at 1/size**2 of the conv cost and activation
+    memory.
+    '''
+    if decoder == 'coarse':
+        return upsample(conv(x), size, name, upsampling)
+    return conv(upsample(x, size, name, upsampling))
+
+
+def build_fcn_models(image_input=None, raw_input=False, head_dtype=None, weights='imagenet',
+                     fc1_rank=None, fc2_rank=None, fc1_method='svd', decoder='full', upsampling='nearest'):
+    '''Builds FCN-32s, FCN-16s and FCN-8s on one VGG16 trunk; the three
+    models share the block3_pool / block4_pool / final_conv_32 layers.
+
+    raw_input=True gives models that take uint8 RGB images and do the VGG16
+    preprocessing in the graph (for stores built with raw=True).
+
+    head_dtype='float16' runs everything after the VGG16 conv blocks (fc1,
+    fc2 and the scoring/upsampling layers) in half precision; the trunk and
+    the softmax stay float32. Half precision weights cannot be trained with
+    the Keras optimizers, so use it to predict with weights loaded from a
+    float32 checkpoint (load_weights(..., by_name=True)). Keras 2 has no
+    bfloat16 floatx.
+
+    weights is passed on to VGG16 (None for a randomly initialised trunk).
+
+    fc1_rank / fc2_rank replace fc1 / fc2 by low-rank factorizations (see
+    low_rank_conv, fc1_method picks the one for fc1; fc2 is 1x1, so always
+    'svd'). low_rank.py fills them from a full-rank checkpoint.
+
+    decoder='coarse' does all the 1x1 scoring convolutions before the
+    upsampling that precedes them (see upsample_score), upsampling='bilinear'
+    uses BilinearUpSampling2D instead of UpSampling2D. Layer names and
+    weights are the same for every decoder, so checkpoints load by name
+    (decoders.py).
+    '''
+    if image_input is None:
+        image_input = Input(shape=(224, 224, 3), dtype='uint8' if raw_input else K.floatx())
+    trunk_input = image_input
+    if raw_input:
+        trunk_input = Lambda(vgg_preprocess, name='vgg_preprocess')(image_input)
+
+    # FCN32s
+    model_32 = VGG16(input_tensor=trunk_input, include_top=True,weights=weights)
+
+    with floatx(head_dtype):
+        model_32, model_16, model_8 = _build_heads(image_input, model_32, head_dtype,
+                                                   fc1_rank, fc2_rank, fc1_method, decoder, upsampling)
+
+    return model_32, model_16, model_8
+
+
+def _build_heads(image_input, model_32, head_dtype, fc1_rank=None, fc2_rank=None, fc1_method='svd',
+                 decoder='full', upsampling='nearest'):
+    out_dtype = None if head_dtype is None else 'float32'
+    up_kwargs = {'decoder': decoder, 'upsampling': upsampling}
+    pool3 = cast(model_32.get_layer('block3_pool').output, head_dtype, 'block3_pool')
+    pool4 = cast(model_32.get_layer('block4_pool').output, head_dtype, 'block4_pool')
+
+    last_layer = cast(model_32.get_layer('block5_pool').output, head_dtype, 'block5_pool')
+    x = last_layer
+
+    # Convolutional layers transfered from fully-connected layers
+    if fc1_rank is None:
+        x = Conv2D(4096, (7, 7), activation='relu', padding='same', name='fc1' )(x)
+    else:
+        x = low_rank_conv(x, 4096, (7, 7), fc1_rank, fc1_method, 'relu', 'fc1')
+    x = Dropout(0.5, name = 'dropout1')(x)
+    if fc2_rank is None:
+        x = Conv2D(4096, (1, 1), activation='relu', padding='same', name='fc2' )(x)
+    else:
+        x = low_rank_conv(x, 4096, (1, 1), fc2_rank, 'svd', 'relu', 'fc2')
+    x = Dropout(0.5, name = 'dropout2')(x)
+
+    #classifying layer
+    x = Conv2D(21, (1, 1), kernel_initializer='he_normal', activation='linear', padding='valid', strides=(1, 1), name = 'final_conv_32' )(x)
+
+    x = upsample_score(x, 32, 'upsampling32', Conv2D(21,(1,1), activation = 'linear', name = 'upsampling32s',init='zero'), **up_kwargs)
+
+    x = cast(x, out_dtype, 'scores_32')
+    x = Activation(image_softmax)(x)
+
+    model_32 = Model(image_input, x)
+
+    # FCN16s
+    second_last_layer = pool4
+    x = Conv2D(21, (1, 1), kernel_initializer='he_normal', activation='linear', padding='valid', strides=(1, 1), name = 'final_conv_16' )(second_last_layer)
+
+    y = model_32.get_layer('final_conv_32').output
+    # was also called 'upsampling32s', which clashed with the FCN32s layer
+    y = upsample_score(y, 2, 'upsampling2x_16', Conv2D(21,(1,1), activation = 'linear', name = 'upsampling2x_16s',kernel_initializer='he_normal'), **up_kwargs)
+
+    new_layer = Add()([x, y])
+    new_layer = upsample_score(new_layer, 16, 'upsampling16', Conv2D(21,(1,1), activation = 'linear', name = 'upsampling16s',kernel_initializer='he_normal'), **up_kwargs)
+
+    new_layer = cast(new_layer, out_dtype, 'scores_16')
+    new_layer=Activation(image_softmax)(new_layer)
+
+    model_16 = Model(image_input, new_layer)
+
+    #FCN8s
+    second_last_layer = pool4
+    x = Conv2D(21, (1, 1), kernel_initializer='he_normal', activation='linear', padding='valid', strides=(1, 1), name = 'final_conv_8_1',kernel_regularizer=regularizers.l2(0.01))(second_last_layer)
+    x = upsample_score(x, 2, 'upsampling2x_8', Conv2D(21,(1,1), strides = (1,1), activation = 'linear', name = 'upsampling2x_8s1',kernel_initializer='he_normal', kernel_regularizer=regularizers.l2(0.01)), **up_kwargs)
+
+    third_last_layer = pool3
+    y = Conv2D(21, (1, 1), kernel_initializer='he_normal', activation='linear', padding='valid', strides=(1, 1), name = 'final_conv_8_2' , kernel_regularizer=regularizers.l2(0.01))(third_last_layer)
+
+    z = model_32.get_layer('final_conv_32').output
+    z = upsample_score(z, 4, 'upsampling4x_8s1', Conv2D(21,(1,1), activation = 'linear', name = 'upsampling4x_8s2',kernel_initializer='he_normal', padding = 'same', kernel_regularizer=regularizers.l2(0.01)), **up_kwargs)
+
+    new_layer = Add(name = 'add_8')([x,y,z])
+    new_layer = upsample_score(new_layer, 8, 'upsampling8x_8', Conv2D(21,(1,1), activation = 'linear', name = 'upsamplingx_82',padding = 'same', kernel_initializer='he_normal', kernel_regularizer=regularizers.l2(0.01)), **up_kwargs)
+
+    new_layer = cast(new_layer, out_dtype, 'scores_8')
+    new_layer = Activation(image_softmax, name = 'softmax_8')(new_layer)
+
+    model_8 = Model(image_input, new_layer)
+
+    return model_32, model_16, model_8
+
+
+# the FCN-8s trunk ends at these layers; everything after them (dropout2,
+# final_conv_32 and the decoder) is the head
+FCN8_TRUNK_OUTPUTS = ('block3_pool', 'block4_pool', 'fc2')
+
+
+def fcn8_trunk_outputs(model_8):
+    '''The tensors of FCN8_TRUNK_OUTPUTS in model_8. fc2 is taken as the
+    input of dropout2, which also covers a factorized fc2 (fc2_a, fc2_b).
+    '''
+    return [model_8.get_layer('dropout2').get_input_at(0) if name == 'fc2' else model_8.get_layer(name).output
+            for name in FCN8_TRUNK_OUTPUTS]
+
+
+def fcn8_trunk(model_8):
+    '''image -> [block3_pool, block4_pool, fc2] part of FCN-8s.'''
+    return Model(model_8.input, fcn8_trunk_outputs(model_8))
+
+
+def _reapply_score(model, x, up_name, conv_name):
+    # conv before upsampling in the layer order means a decoder='coarse' model
+    up, conv = model.get_layer(up_name), model.get_layer(conv_name)
+    if model.layers.index(conv) < model.layers.index(up):
+        return up(conv(x))
+    return conv(up(x))
+
+
+def fcn8_head(model_8):
+    '''The FCN-8s head as a model on the fcn8_trunk features. It calls the
+    layers of model_8 again rather than copying them, so training the head
+    trains model_8.
+    '''
+    pool3, pool4, fc2 = [Input(shape=K.int_shape(t)[1:], name=name + '_features')
+                         for name, t in zip(FCN8_TRUNK_OUTPUTS, fcn8_trunk_outputs(model_8))]
+
+    x = model_8.get_layer('final_conv_8_1')(pool4)
+    x = _reapply_score(model_8, x, 'upsampling2x_8', 'upsampling2x_8s1')
+
+    y = model_8.get_layer('final_conv_8_2')(pool3)
+
+    z = model_8.get_layer('dropout2')(fc2)
+    z = model_8.get_layer('final_conv_32')(z)
+    z = _reapply_score(model_8, z, 'upsampling4x_8s1', 'upsampling4x_8s2')
+
+    new_layer = model_8.get_layer('add_8')([x, y, z])
+    new_layer = _reapply_score(model_8, new_layer, 'upsampling8x_8', 'upsamplingx_82')
+    new_layer = model_8.get_layer('softmax_8')(new_layer)
+
+    return Model([pool3, pool4, fc2], new_layer)
+
+
+def build_multihead(model_32, model_16, model_8, ensemble=False):
+    '''One model with the FCN-32s, FCN-16s and FCN-8s outputs (plus their
+    average with ensemble=True). The models must come from the same
+    build_fcn_models call, so a single predict evaluates the shared trunk
+    once instead of three times.
+    '''
+    outputs = [model_32.output, model_16.output, model_8.output]
+    if ensemble:
+        outputs.append(Average(name='fcn_ensemble')(outputs))
+    return Model(model_8.input, outputs)
+
+
+# current layer name -> the name older checkpoints saved it under
+LEGACY_LAYER_NAMES = {'upsampling2x_16s': 'upsampling32s'}
+
+
+def _saved_weights(filepath, layer_names=None):
+    '''Layer name -> list of weight arrays of a Keras .h5 model or weights
+    file, for the layers with weights (only those in layer_names if given).
+    '''
+    import h5py
+
+    weights = {}
+    with h5py.File(filepath, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        for name in group:
+            if layer_names is not None and name not in layer_names:
+                continue
+            names = [n.decode('utf8') if isinstance(n, bytes) else n
+                     for n in group[name].attrs.get('weight_names', [])]
+            if names:
+                weights[name] = [np.asarray(group[name][n]) for n in names]
+    return weights
+
+
+def _saved_layer_names(filepath):
+    '''Names of the layers with weights in a Keras .h5 model or weights file.'''
+    import h5py
+
+    with h5py.File(filepath, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        return set(name for name in group if len(group[name].attrs.get('weight_names', [])))
+
+
+def load_weights(model, filepath):
+    '''model.load_weights(filepath, by_name=True) that also fills layers
+    renamed since the checkpoint was written (LEGACY_LAYER_NAMES) and warns
+    about any other layer with weights that the file has nothing for.
+    '''
+    model.load_weights(filepath, by_name=True)
+    saved = _saved_layer_names(filepath)
+    for layer in model.layers:
+        if not layer.weights or layer.name in saved:
+            continue
+        legacy = LEGACY_LAYER_NAMES.get(layer.name)
+        if legacy in saved:
+            layer.set_weights(_saved_weights(filepath, [legacy])[legacy])
+        else:
+            warnings.warn('%s has no weights for layer %s, it keeps its initial weights' % (filepath, layer.name))
+
+
+def check_shared_weights(filepaths, layer_names):
+    '''Raises ValueError if the checkpoints in filepaths hold different
+    weights for any of layer_names. Read one layer at a time, so only two
+    copies of a layer are in memory.
+    '''
+    mismatched = []
+    for name in sorted(layer_names):
+        ref = None
+        for filepath in filepaths:
+            weights = _saved_weights(filepath, [name]).get(name)
+            if weights is None:
+                continue
+            if ref is None:
+                ref = weights
+            elif len(weights) != len(ref) or not all(np.array_equal(a, b) for a, b in zip(weights, ref)):
+                mismatched.append(name)
+                break
+    if mismatched:
+        raise ValueError('%s hold different weights for the shared layers %s. The FCN-32s/16s/8s heads '
+                         'share one trunk, so load_multihead needs checkpoints from one joint training run.'
+                         % (', '.join(filepaths), ', '.join(mismatched)))
+
+
+def load_multihead(filepath_8, filepath_16=None, filepath_32=None, ensemble=False):
+    '''Builds the multi-head model and fills it from saved checkpoints by
+    layer name. The heads share the trunk (VGG16, fc1, fc2, final_conv_32),
+    so the checkpoints have to come from one joint training run: fc1/fc2
+    are random in every build, and separately trained checkpoints disagree
+    on them. check_shared_weights raises in that case.
+    '''
+    model_32, model_16, model_8 = build_fcn_models()
+    loads = [(filepath, model) for filepath, model in
+             ((filepath_32, model_32), (filepath_16, model_16), (filepath_8, model_8)) if filepath is not None]
+    shared = set()
+    for i, (_, a) in enumerate(loads):
+        for _, b in loads[i + 1:]:
+            shared |= set(l.name for l in a.layers if l.weights) & set(l.name for l in b.layers)
+    check_shared_weights([filepath for filepath, _ in loads], shared)
+    for filepath, model in loads:
+        load_weights(model, filepath)
+    return build_multihead(model_32, model_16, model_8, ensemble)
@@ -0,0 +1,93 @@
+'''Post-training int8 quantization of a trained FCN-8s .h5 model.
+
+The weights and, using activation ranges measured on a calibration subset
+of X_val, the activations are quantized to int8 by the TensorFlow Lite
+converter. Input and output stay float32, so the .tflite file is a drop-in
+replacement for the .h5 in inference.py / server.py (--model
+model.int8.tflite). A report compares file size, batch-1 latency and mIoU
+on X_fin_test against the float model.
+
+    python quantize.py --model model_fcn_8s_tran_init.h5 --output model_fcn_8s.int8.tflite --report int8.json
+'''
+import argparse
+import os
+
+import numpy as np
+
+import dataset_store
+import inference
+from benchmarking import predict_latency, write_report
+from evaluation import evaluate_model
+
+
+def calibration_images(X, n_calib=100, seed=0):
+    '''n_calib images of X picked at random, in store order.'''
+    idx = np.sort(np.random.RandomState(seed).choice(len(X), min(n_calib, len(X)), replace=False))
+    return np.asarray(X[idx], dtype=np.float32)
+
+
+def export_int8(model, X_calib, filepath):
+    '''Converts a Keras model to an int8 .tflite file, calibrating the
+    activation ranges on X_calib (preprocessed images, one at a time).
+    Operations without an int8 kernel are left in float.
+    '''
+    import tensorflow as tf
+    import keras.backend as K
+
+    converter = tf.lite.TFLiteConverter.from_session(K.get_session(), [model.input], [model.output])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    def representative_images():
+        for x in X_calib:
+            yield [x[np.newaxis]]
+
+    # the TF 1.x converter reads .input_gen, a bare generator function is not enough
+    converter.representative_dataset = tf.lite.RepresentativeDataset(representative_images)
+    with open(filepath, 'wb') as f:
+        f.write(converter.convert())
+    return filepath
+
+
+def compare(float_path, int8_path, X, y, batch_size=8):
+    results = {}
+    for name, path in (('float', float_path), ('int8', int8_path)):
+        model = inference.get_model(path, 'softmax')
+        cm = evaluate_model(model, X, y, batch_size=batch_size)
+        results[name] = {'file': path,
+                         'size_bytes': os.path.getsize(path),
+                         'latency_s': predict_latency(model, X, 1, repeat=20),
+                         'mean_IoU': cm.mean_IoU(),
+                         'pixel_acc': cm.pixel_acc()}
+    results['size_ratio'] = results['int8']['size_bytes'] / float(results['float']['size_bytes'])
+    results['speedup'] = results['float']['latency_s'] / results['int8']['latency_s']
+    results['mean_IoU_delta'] = results['int8']['mean_IoU'] - results['float']['mean_IoU']
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=inference.DEFAULT_MODEL)
+    parser.add_argument('--output', help='defaults to the model name with .int8.tflite')
+    parser.add_argument('--X-calib', default='X_val.npy', help='store the calibration images are drawn from')
+    parser.add_argument('--n-calib', type=int, default=100)
+    parser.add_argument('--X', default='X_fin_test.npy', help='images the report is computed on')
+    parser.add_argument('--y', default='y_fin_test.npy')
+    parser.add_argument('--n-eval', type=int, default=200)
+    parser.add_argument('--report', help='write the comparison as JSON to this file')
+    args = parser.parse_args()
+    output = args.output or os.path.splitext(args.model)[0] + '.int8.tflite'
+
+    import keras.backend as K
+    K.set_learning_phase(0)  # export the inference graph, without the dropout switches
+
+    model = inference.get_model(args.model, 'softmax')
+    X_calib = calibration_images(dataset_store.open_array(args.X_calib), args.n_calib)
+    if inference.takes_raw(model):
+        X_calib = X_calib.astype(np.uint8)
+    export_int8(model, X_calib, output)
+    print('wrote %s' % output)
+
+    X = np.asarray(dataset_store.open_array(args.X)[:args.n_eval])
+    y = np.asarray(dataset_store.open_array(args.y)[:args.n_eval])
+    report = compare(args.model, output, X, y)
+    write_report(report, args.report)
@@ -0,0 +1,202 @@
+'''Local HTTP segmentation server with dynamic micro-batching.
+
+Concurrent requests are queued and collected into batches of up to
+--max-batch-size images, waiting at most --max-wait-ms for a batch to fill,
+and each batch is one forward pass of the FCN-8s label model.
+
+    python server.py --model model_fcn_8s_tran_init.h5 --port 8080
+
+    POST /segment             body: a JPEG/PNG image -> palettized PNG mask
+    POST /segment?format=rle  -> {"shape": [h, w], "rle": [[label, run], ...]}
+    GET  /stats               -> queue depth, batch size histogram, latencies
+
+The server only listens on 127.0.0.1.
+'''
+import argparse
+import asyncio
+import io
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+import inference
+
+HOST = '127.0.0.1'
+
+
+def rle_encode(labels):
+    '''Run-length encodes a label map in row-major order as [label, run] pairs.'''
+    flat = np.asarray(labels).ravel()
+    if flat.size == 0:
+        return []
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    runs = np.diff(np.concatenate((starts, [flat.size])))
+    return [[int(v), int(n)] for v, n in zip(flat[starts], runs)]
+
+
+def encode_png(labels):
+    from data_utils import labels_to_images, palette
+
+    buf = io.BytesIO()
+    labels_to_images(labels[np.newaxis], palette)[0].save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def decode_image(data, target_size=(224, 224)):
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    return np.asarray(img.resize((target_size[1], target_size[0]), Image.NEAREST), dtype=np.uint8)
+
+
+class MicroBatcher(object):
+    '''Collects single-image requests into batches for predict_fn.
+
+    predict_fn takes a (batch, h, w, 3) uint8 array and returns (batch, h, w)
+    label maps; it runs on a single worker thread so the event loop keeps
+    accepting requests while a batch is being computed.
+    '''
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=10):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batch_sizes = Counter()
+        self.n_requests = 0
+        self.latencies = []
+
+    async def submit(self, img):
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((img, future, time.time()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batch_sizes[len(batch)] += 1
+            images = np.stack([img for img, _, _ in batch])
+            try:
+                labels = await loop.run_in_executor(self.executor, self.predict_fn, images)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.time()
+            for (_, future, queued), label_map in zip(batch, labels):
+                if not future.done():
+                    future.set_result(label_map)
+                self.latencies.append(now - queued)
+            self.n_requests += len(batch)
+            del self.latencies[:-10000]
+
+    def stats(self):
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {'queue_depth': self.queue.qsize(),
+                'requests': self.n_requests,
+                'batches': sum(self.batch_sizes.values()),
+                'batch_size_histogram': dict((str(k), v) for k, v in sorted(self.batch_sizes.items())),
+                'latency_ms': {'p50': float(np.percentile(latencies, 50) * 1000),
+                               'p99': float(np.percentile(latencies, 99) * 1000)}}
+
+
+async def write_response(writer, status, body, content_type):
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+    head = ('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n'
+            % (status, reason, content_type, len(body)))
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+
+def json_body(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+async def handle(batcher, reader, writer):
+    # image decoding and mask encoding run on the default thread pool so they
+    # do not hold up the event loop while batches are being collected
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, _ = lines[0].split(' ', 2)
+            headers = dict((k.strip().lower(), v.strip()) for k, v in
+                           (line.split(':', 1) for line in lines[1:] if ':' in line))
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            url = urlparse(target)
+
+            if method == 'GET' and url.path == '/stats':
+                await write_response(writer, 200, json_body(batcher.stats()), 'application/json')
+            elif method == 'POST' and url.path == '/segment':
+                fmt = parse_qs(url.query).get('format', ['png'])[0]
+                try:
+                    img = await loop.run_in_executor(None, decode_image, body)
+                except Exception as e:
+                    await write_response(writer, 400, json_body({'error': str(e)}), 'application/json')
+                    continue
+                try:
+                    labels = await batcher.submit(img)
+                except Exception as e:
+                    await write_response(writer, 500, json_body({'error': str(e)}), 'application/json')
+                    continue
+                if fmt == 'rle':
+                    rle = await loop.run_in_executor(None, rle_encode, labels)
+                    result = {'shape': list(labels.shape), 'rle': rle}
+                    await write_response(writer, 200, json_body(result), 'application/json')
+                else:
+                    png = await loop.run_in_executor(None, encode_png, labels)
+                    await write_response(writer, 200, png, 'image/png')
+            else:
+                await write_response(writer, 404, json_body({'error': 'not found'}), 'application/json')
+
+            if headers.get('connection', '').lower() == 'close':
+                break
+    finally:
+        writer.close()
+
+
+async def serve(predict_fn, port=8080, max_batch_size=8, max_wait_ms=10):
+    batcher = MicroBatcher(predict_fn, max_batch_size, max_wait_ms)
+    batch_task = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(lambda r, w: handle(batcher, r, w), HOST, port)
+    print('serving on http://%s:%d' % (HOST, port))
+    try:
+        await server.serve_forever()
+    finally:
+        batch_task.cancel()
+        server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=inference.DEFAULT_MODEL)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    args = parser.parse_args()
+
+    # load before accepting connections so the first request does not pay for it
+    inference.get_model(args.model)
+    asyncio.run(serve(lambda images: inference.predict(images, args.model, batch_size=len(images)),
+                      args.port, args.max_batch_size, args.max_wait_ms))
@@ -0,0 +1,51 @@
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from callbacks import TimingLogger
+from metrics import segmentation_metrics, sparse_mean_IoU, sparse_mean_acc, sparse_pixel_acc
+
+
+class FixedModel(object):
+    '''Stands in for a trained model: predict returns fixed softmax scores.'''
+
+    def __init__(self, y_pred):
+        self.y_pred = y_pred
+
+    def predict(self, X):
+        return self.y_pred
+
+
+def test_time_metrics_with_sparse_metrics(tmpdir):
+    rng = np.random.RandomState(0)
+    y = rng.randint(0, 21, (2, 8, 8, 1)).astype(np.uint8)
+    y_pred = rng.dirichlet(np.ones(21), (2, 8, 8)).astype(np.float32)
+    metrics = {'mean_IoU': sparse_mean_IoU, 'mean_acc': sparse_mean_acc, 'pixel_acc': sparse_pixel_acc,
+               'segmentation_metrics': lambda y_true, y_pred: [m(y_true, y_pred) for m in segmentation_metrics()]}
+    logger = TimingLogger(str(tmpdir.join('log.jsonl')), metrics=metrics, sample=(np.zeros((2, 8, 8, 3)), y))
+    logger.set_model(FixedModel(y_pred))
+
+    times = logger.time_metrics()
+    assert sorted(times) == sorted(metrics)
+    assert all(t >= 0 for t in times.values())
+
+
+def test_epoch_end_record(tmpdir):
+    path = str(tmpdir.join('log.jsonl'))
+    y = np.zeros((1, 4, 4, 1), dtype=np.uint8)
+    logger = TimingLogger(path, metrics={'pixel_acc': sparse_pixel_acc}, sample=(np.zeros((1, 4, 4, 3)), y))
+    logger.set_model(FixedModel(np.full((1, 4, 4, 21), 1 / 21.0, dtype=np.float32)))
+    logger.on_train_begin()
+    logger.on_epoch_begin(0)
+    logger.on_batch_begin(0)
+    logger.on_batch_end(0, {'size': 1})
+    logger.on_epoch_end(0, {'loss': 1.0})
+    logger.on_train_end()
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert [r['event'] for r in records] == ['batch', 'epoch']
+    assert set(records[-1]['metric_eval_s']) == {'pixel_acc'}
@@ -0,0 +1,49 @@
+import numpy as np
+
+from data_utils import IGNORE_INDEX, convert_from_color_segmentation, palette
+
+
+def loop_convert_from_color_segmentation(arr_3d, palette):
+    '''The per-colour decoder train.py used before the lookup table. It left
+    colours outside the palette at 0; the table marks them IGNORE_INDEX.
+    '''
+    arr_2d = np.zeros((arr_3d.shape[0], arr_3d.shape[1]), dtype=np.uint8)
+    known = np.zeros(arr_2d.shape, dtype=bool)
+
+    for c, i in palette.items():
+        m = np.all(arr_3d == np.array(c).reshape(1, 1, 3), axis=2)
+        arr_2d[m] = i
+        known |= m
+
+    arr_2d[~known] = IGNORE_INDEX
+    return arr_2d
+
+
+def label_images(n=4, seed=0):
+    '''VOC-like label images: palette colours, the (224, 224, 192) boundary
+    and a few colours outside the palette.
+    '''
+    rng = np.random.RandomState(seed)
+    colors = np.array(list(palette.keys()) + [(224, 224, 192), (1, 2, 3), (255, 255, 255), (128, 0, 1)],
+                      dtype=np.uint8)
+    return colors[rng.randint(len(colors), size=(n, 224, 224))]
+
+
+def test_matches_loop_decoder():
+    for arr_3d in label_images():
+        np.testing.assert_array_equal(convert_from_color_segmentation(arr_3d, palette),
+                                      loop_convert_from_color_segmentation(arr_3d, palette))
+
+
+def test_batch_matches_single_images():
+    batch = label_images()
+    decoded = convert_from_color_segmentation(batch, palette)
+    assert decoded.shape == batch.shape[:3] and decoded.dtype == np.uint8
+    for arr_3d, arr_2d in zip(batch, decoded):
+        np.testing.assert_array_equal(arr_2d, loop_convert_from_color_segmentation(arr_3d, palette))
+
+
+def test_boundary_and_unknown_colors_are_ignored():
+    arr_3d = np.array([[(224, 224, 192), (1, 2, 3), (0, 0, 0), (128, 0, 0), (0, 64, 128)]], dtype=np.uint8)
+    np.testing.assert_array_equal(convert_from_color_segmentation(arr_3d, palette),
+                                  [[IGNORE_INDEX, IGNORE_INDEX, 0, 1, 20]])
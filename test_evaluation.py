@@ -0,0 +1,64 @@
+import numpy as np
+
+from data_utils import IGNORE_INDEX
+from evaluation import ConfusionMatrix
+
+
+def brute_force_matrix(y_true, y_pred, n_classes):
+    '''Counts every (true, predicted) pair pixel by pixel, skipping pixels
+    labelled IGNORE_INDEX.
+    '''
+    matrix = np.zeros((n_classes, n_classes), dtype=np.int64)
+    for t, p in zip(np.ravel(y_true), np.ravel(y_pred)):
+        if t != IGNORE_INDEX:
+            matrix[t, p] += 1
+    return matrix
+
+
+def brute_force_iou(matrix):
+    iou = []
+    for c in range(len(matrix)):
+        tp = matrix[c, c]
+        union = matrix[c, :].sum() + matrix[:, c].sum() - tp
+        iou.append(tp / float(union) if union else np.nan)
+    return np.array(iou)
+
+
+def label_maps(n=3, n_classes=6, seed=0):
+    '''Label maps and predictions that use classes 0-3 only, so 4 and 5 are
+    missing from both, with some pixels set to IGNORE_INDEX.
+    '''
+    rng = np.random.RandomState(seed)
+    y_true = rng.randint(4, size=(n, 17, 23)).astype(np.uint8)
+    y_true[rng.rand(*y_true.shape) < 0.1] = IGNORE_INDEX
+    y_pred = np.where(rng.rand(*y_true.shape) < 0.7, y_true, rng.randint(4, size=y_true.shape)).astype(np.uint8)
+    y_pred[y_true == IGNORE_INDEX] = rng.randint(4, size=np.count_nonzero(y_true == IGNORE_INDEX))
+    return y_true, y_pred
+
+
+def test_matches_brute_force_count():
+    y_true, y_pred = label_maps()
+    cm = ConfusionMatrix(6).update(y_true, y_pred)
+    expected = brute_force_matrix(y_true, y_pred, 6)
+    np.testing.assert_array_equal(cm.matrix, expected)
+    assert cm.matrix.sum() == np.count_nonzero(y_true != IGNORE_INDEX)
+    np.testing.assert_allclose(cm.iou(), brute_force_iou(expected))
+    np.testing.assert_allclose(cm.pixel_acc(), np.trace(expected) / float(expected.sum()))
+
+
+def test_missing_classes_are_left_out_of_the_mean():
+    y_true, y_pred = label_maps()
+    cm = ConfusionMatrix(6).update(y_true, y_pred)
+    iou = cm.iou()
+    assert np.isnan(iou[4:]).all() and not np.isnan(iou[:4]).any()
+    assert np.isnan(cm.class_acc()[4:]).all()
+    np.testing.assert_allclose(cm.mean_IoU(), brute_force_iou(cm.matrix)[:4].mean())
+
+
+def test_scores_and_merged_batches():
+    y_true, y_pred = label_maps()
+    scores = np.eye(6, dtype=np.float32)[y_pred]
+    merged = ConfusionMatrix(6)
+    for t, s in zip(y_true, scores):
+        merged.merge(ConfusionMatrix(6).update(t, s))
+    np.testing.assert_array_equal(merged.matrix, brute_force_matrix(y_true, y_pred, 6))
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from inference import check_overlap, predict_tiled, tile_starts
+
+
+class PixelModel(object):
+    '''Stands in for a fully convolutional model: the scores of every pixel
+    depend on that pixel only. The vgg_preprocess layer makes
+    inference.preprocess pass the uint8 tiles through untouched.
+    '''
+
+    class Layer(object):
+        name = 'vgg_preprocess'
+
+    layers = [Layer()]
+
+    def __init__(self, n_classes=5):
+        self.n_classes = n_classes
+        self.calls = 0
+
+    def scores(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        c = np.arange(self.n_classes, dtype=np.float32)
+        return np.cos(X[..., :1] * 0.1 + c) + X[..., 1:2] / 255.0 * c - X[..., 2:] / 255.0 * c ** 2
+
+    def predict(self, X, batch_size=8):
+        assert X.dtype == np.uint8 and len(X) <= batch_size
+        self.calls += 1
+        return self.scores(X)
+
+
+def image(shape, seed=0):
+    return np.random.RandomState(seed).randint(0, 256, shape + (3,)).astype(np.uint8)
+
+
+def test_tiled_matches_untiled():
+    model = PixelModel()
+    img = image((300, 250))
+    labels = predict_tiled(model, img, tile_size=(64, 64), overlap=16, batch_size=3)
+    assert labels.shape == (300, 250) and labels.dtype == np.uint8
+    np.testing.assert_array_equal(labels, model.scores(img).argmax(axis=-1))
+    assert model.calls == len(tile_starts(300, 64, 48)) * -(-len(tile_starts(250, 64, 48)) // 3)
+
+
+def test_tiles_cover_the_borders():
+    covered = np.zeros((300, 250), dtype=int)
+    for y in tile_starts(300, 64, 48):
+        for x in tile_starts(250, 64, 48):
+            covered[y:y + 64, x:x + 64] += 1
+    assert covered.min() >= 1
+    assert covered[-1].all() and covered[:, -1].all()
+
+
+def test_small_image_is_padded():
+    model = PixelModel()
+    img = image((40, 50), seed=1)
+    labels = predict_tiled(model, img, tile_size=(64, 64), overlap=16)
+    np.testing.assert_array_equal(labels, model.scores(img).argmax(axis=-1))
+
+
+def test_overlap_must_leave_a_stride():
+    check_overlap((64, 64), 0)
+    for overlap in (-1, 64, 100):
+        with pytest.raises(ValueError):
+            check_overlap((64, 64), overlap)
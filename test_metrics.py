@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+
+from keras.layers import Activation, Conv2D, Input
+from keras.models import Model
+
+import inference
+from evaluation import ConfusionMatrix
+from metrics import segmentation_metrics, sparse_fcn_xent_nobg
+from models import image_softmax
+
+
+def compiled_model():
+    image_input = Input(shape=(8, 8, 3))
+    x = Conv2D(21, (1, 1), name='score')(image_input)
+    model = Model(image_input, Activation(image_softmax)(x))
+    model.compile(loss=sparse_fcn_xent_nobg, optimizer='sgd', metrics=segmentation_metrics())
+    return model
+
+
+def sample(n=4, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.uniform(-1, 1, (n, 8, 8, 3)).astype(np.float32)
+    y = rng.randint(0, 21, (n, 8, 8, 1)).astype(np.uint8)
+    y[0, :2] = 255
+    return X, y
+
+
+def test_segmentation_metrics_match_confusion_matrix():
+    X, y = sample()
+    model = compiled_model()
+    # one image per batch: the scores must cover all of them, not the last batch
+    scores = dict(zip(model.metrics_names, model.evaluate(X, y, batch_size=1, verbose=0)))
+    cm = ConfusionMatrix(21).update(y[..., 0], model.predict(X))
+    assert scores['mean_IoU'] == pytest.approx(cm.mean_IoU(), rel=1e-5)
+    assert scores['mean_acc'] == pytest.approx(cm.mean_acc(), rel=1e-5)
+    assert scores['pixel_acc'] == pytest.approx(cm.pixel_acc(), rel=1e-5)
+
+
+def test_saved_model_with_segmentation_metrics_loads(tmpdir):
+    X, y = sample()
+    model = compiled_model()
+    model.fit(X, y, batch_size=2, epochs=1, verbose=0)
+
+    path = str(tmpdir.join('model.h5'))
+    model.save(path)
+    loaded = inference.get_model(path, 'softmax')
+    np.testing.assert_allclose(loaded.predict(X), model.predict(X), rtol=1e-5)
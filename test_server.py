@@ -0,0 +1,46 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import server
+
+
+def test_rle_round_trip():
+    labels = np.array([[0, 0, 5], [5, 5, 255]], dtype=np.uint8)
+    rle = server.rle_encode(labels)
+    assert rle == [[0, 2], [5, 3], [255, 1]]
+    np.testing.assert_array_equal(np.repeat([v for v, _ in rle], [n for _, n in rle]).reshape(labels.shape),
+                                  labels)
+
+
+def test_micro_batcher_with_keras_model(tmpdir):
+    pytest.importorskip('keras')
+    from keras.layers import Activation, Conv2D, Input
+    from keras.models import Model
+
+    import inference
+    from models import image_softmax
+
+    image_input = Input(shape=(8, 8, 3))
+    x = Conv2D(21, (1, 1), name='score')(image_input)
+    path = str(tmpdir.join('model.h5'))
+    Model(image_input, Activation(image_softmax)(x)).save(path)
+    inference.get_model(path)
+
+    images = np.random.RandomState(0).randint(0, 256, (5, 8, 8, 3)).astype(np.uint8)
+    expected = inference.predict(images, path, batch_size=len(images))
+
+    async def segment_all():
+        # predict_fn runs on the batcher's worker thread, not the loading thread
+        batcher = server.MicroBatcher(lambda batch: inference.predict(batch, path, batch_size=len(batch)),
+                                      max_batch_size=4, max_wait_ms=50)
+        task = asyncio.ensure_future(batcher.run())
+        try:
+            return await asyncio.gather(*[batcher.submit(img) for img in images]), batcher.stats()
+        finally:
+            task.cancel()
+
+    labels, stats = asyncio.run(segment_all())
+    np.testing.assert_array_equal(np.stack(labels), expected)
+    assert stats['requests'] == len(images) and stats['batches'] >= 2